@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 
+import hashlib
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
 import os
 import pickle
+import random
+import re
+import shutil
+import struct
+import sys
 import threading
+import time
 import traceback
+import urllib.parse
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import boto3
+import numpy as np
 from azure.ai.ml import MLClient
 from azure.identity import InteractiveBrowserCredential
 from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
 from lightgbm import *
 from sklearn import *
 
-from btpeer import BTPeer, btdebug
+from btpeer import BTPeer, BTPeerConnection, btdebug
 
 PING = 'PING'
 PEERNAME = 'NAME'   # request a peer's canonical id
@@ -22,11 +39,224 @@ INSERTPEER = 'JOIN'
 QUERY = 'QUER'
 QRESPONSE = 'RESP'
 INFER = 'INFR'
+INFERBINARY = 'INFB'    # INFER with the input and predictions as raw arrays
 PEERQUIT = 'QUIT'
+STATS = 'STAT'      # request a peer's metrics
+FETCH = 'FTCH'      # request the file a peer loaded a model from
 
 REPLY = 'REPL'
 ERROR = 'ERRO'
 
+# optional "key=value" settings that may precede the input of an INFR message
+OPTION = re.compile(r'(\w+)=(\S*)\s+')
+
+# longest header line accepted in front of a binary array
+MAXTENSORHEADER = 1024
+
+# mapped model files (see save_mapped_model): magic, then the lengths of
+# the pickle and of the buffer table
+MAPPEDMAGIC = b'BTMLMAP1'
+MAPPEDHEADER = struct.Struct('<8sQQ')
+MAPPEDBUFFER = struct.Struct('<QQ')     # offset, length
+MAPPEDSUFFIX = '.mlm'
+# arrays smaller than this stay inside the pickle
+MAPPEDTHRESHOLD = 4096
+
+
+def encode_tensor(header, array):
+    """
+    encode_tensor(header words, array) -> bytes
+
+    Encodes an array for an INFERBINARY message or reply: a line of text
+    holding the header words (if any), the array's dtype and its
+    comma-separated shape, followed by the array's contents as raw
+    little-endian bytes in C order.
+    """
+
+    array = np.asarray(array)
+    if array.dtype.hasobject:   # e.g. class labels of mixed types
+        array = array.astype(str)
+    array = np.ascontiguousarray(array, array.dtype.newbyteorder('<'))
+    line = ' '.join(filter(None, [header, array.dtype.str,
+                                  ','.join(map(str, array.shape))]))
+    return b''.join([(line + '\n').encode(), array.reshape(-1).view(np.uint8)])
+
+
+def decode_tensor(data):
+    """
+    decode_tensor(bytes-like data) -> (header words, array)
+
+    Decodes what encode_tensor encoded. The array is a read-only view of
+    data rather than a copy.
+    """
+
+    view = memoryview(data).cast('B')
+    end = bytes(view[:MAXTENSORHEADER]).find(b'\n')
+    if end < 0:
+        raise ValueError('no array header')
+    *header, dtype, shape = str(view[:end], 'utf-8').split()
+    dtype = np.dtype(dtype)
+    if dtype.hasobject:
+        raise ValueError('object arrays cannot be decoded')
+    shape = tuple(int(n) for n in shape.split(','))
+    return header, np.frombuffer(view, dtype, offset=end + 1).reshape(shape)
+
+
+def save_mapped_model(model, path):
+    """
+    save_mapped_model(model, path) -> ()
+
+    Saves a model in the mapped format: a pickle (protocol 5) of the
+    model in which every contiguous NumPy array of MAPPEDTHRESHOLD bytes
+    or more is left out, followed by those arrays' contents, each at an
+    offset aligned to a page. load_mapped_model maps the file instead of
+    reading it, so the arrays are paged in lazily and shared by every
+    process on the host that loads the same file. Only models that keep
+    the NumPy arrays they are unpickled with share them this way; those
+    that copy them into structures of their own, like the trees of
+    scikit-learn ensembles, load no faster than from a pickle and share
+    nothing.
+    """
+
+    buffers = []
+
+    def outofband(buffer):
+        raw = buffer.raw()
+        if raw.nbytes < MAPPEDTHRESHOLD:
+            return True     # keep it in the pickle
+        buffers.append(raw)
+        return False
+
+    data = pickle.dumps(model, 5, buffer_callback=outofband)
+
+    align = mmap.ALLOCATIONGRANULARITY
+    offset = MAPPEDHEADER.size + MAPPEDBUFFER.size * len(buffers) + len(data)
+    table = []
+    for raw in buffers:
+        offset += -offset % align
+        table.append((offset, raw.nbytes))
+        offset += raw.nbytes
+
+    tmppath = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(MAPPEDHEADER.pack(MAPPEDMAGIC, len(data), len(buffers)))
+            for entry in table:
+                f.write(MAPPEDBUFFER.pack(*entry))
+            f.write(data)
+            for (offset, _), raw in zip(table, buffers):
+                f.write(bytes(offset - f.tell()))
+                f.write(raw)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def load_mapped_model(path):
+    """
+    load_mapped_model(path) -> (model, bytes of memory outside the mapping)
+
+    Loads a model saved by save_mapped_model. Its large arrays are
+    read-only views of the mapped file, unless the model copied them
+    (see save_mapped_model), in which case they count as memory it takes.
+    """
+
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        magic, datalen, nbuffers = MAPPEDHEADER.unpack_from(view)
+        if magic != MAPPEDMAGIC:
+            raise ValueError('%s is not a mapped model' % path)
+        table = MAPPEDBUFFER.size * nbuffers
+        buffers = [view[offset:offset + length] for offset, length in
+                   MAPPEDBUFFER.iter_unpack(view[MAPPEDHEADER.size:MAPPEDHEADER.size + table])]
+        start = MAPPEDHEADER.size + table
+        model = pickle.loads(view[start:start + datalen], buffers=buffers)
+    finally:
+        # the arrays keep the mapping alive for as long as they need it
+        view.release()
+
+    # pickling the model again, without copying its arrays, finds the
+    # arrays that are not views of the mapping
+    base = np.frombuffer(mapped, np.uint8).ctypes.data
+    footprint = 0
+
+    def unmapped(buffer):
+        nonlocal footprint
+        raw = buffer.raw()
+        if raw.nbytes:
+            address = np.frombuffer(raw, np.uint8).ctypes.data
+            if not base <= address < base + len(mapped):
+                footprint += raw.nbytes
+        return False
+
+    inband = len(pickle.dumps(model, 5, buffer_callback=unmapped))
+    return model, footprint + inband
+
+
+def ismappedmodel(path):
+    """Returns whether the file at path is in the mapped format."""
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAPPEDMAGIC)) == MAPPEDMAGIC
+
+
+def read_model(path, compile=False):
+    """
+    read_model(path, compile it?) -> (model, bytes read into memory)
+
+    Loads a model from a pickle file or a mapped model file, and compiles
+    it if asked to and it can be (see compile_model).
+    """
+
+    if ismappedmodel(path):
+        model, size = load_mapped_model(path)
+    else:
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+            size = f.tell()
+    if compile:
+        compiled = compile_model(model)
+        if compiled is not None:
+            model, size = compiled, size + compiled.nbytes
+    return model, size
+
+
+def find_model_file(path):
+    """
+    find_model_file(path of file or directory) -> path of model file, or None
+
+    Returns path if it is a file, or else the first pickle or mapped model
+    file in the directory, preferring a mapped one.
+    """
+
+    if os.path.isfile(path):
+        return path
+    if os.path.isdir(path):
+        for file in sorted(os.listdir(path), key=lambda file: not file.endswith(MAPPEDSUFFIX)):
+            if file.endswith(('.pkl', '.pickle', MAPPEDSUFFIX)):
+                return os.path.join(path, file)
+    return None
+
+
+def convert_model(path, mapped_path=None):
+    """
+    convert_model(path of pickle file, path of mapped model file) -> path
+
+    Converts a pickled model to the mapped format (see save_mapped_model),
+    by default into a file next to it with the MAPPEDSUFFIX extension.
+    """
+
+    if mapped_path is None:
+        mapped_path = os.path.splitext(path)[0] + MAPPEDSUFFIX
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    save_mapped_model(model, mapped_path)
+    return mapped_path
+
 
 class MLPeer(BTPeer):
     """
@@ -44,32 +274,117 @@ class MLPeer(BTPeer):
 
         BTPeer.__init__(self, maxpeers, serverport, myid, serverhost)
 
-        # modelname --> model mapping
-        self.models = {}
+        # modelname --> model mapping; set self.models.budget to a number
+        # of bytes to keep only the most recently used models in memory,
+        # and self.models.compile to False to run tree ensembles natively
+        self.models = MLModelRegistry(metrics=self.metrics, compile=True)
+
+        # modelname --> (peerid, host, port) mapping; locations of other
+        # peers' models expire, and are looked up again before they do if
+        # they are in use, with queries going query_ttl levels deep
+        self.model_map = MLModelMap(metrics=self.metrics,
+                                    refresh=self.__refresh_model)
+        self.query_ttl = 3
 
-        # modelname --> (peerid, host, port) mapping
-        self.model_map = {}
+        # replicas failing this many requests in a row are dropped
+        self.max_replica_failures = 3
+
+        # modelname --> MLBatcher, for models with batching enabled
+        self.batchers = {}
+
+        # MLResultCache of predictions by input row, if enabled
+        self.result_cache = None
+
+        # MLProcessPool running the models, if enabled
+        self.process_pool = None
+
+        # fetches and loads models, in the background if asked to
+        self.loader = MLModelLoader(self.__load_model_file, self.metrics)
+
+        # model file path ==> (size, modification time, SHA-256 digest)
+        self.artifact_digests = {}
+        self.digestlock = threading.Lock()
+
+        # query id --> time.monotonic() until which repeats of the query
+        # (and of responses to it) are dropped, oldest first
+        self.seen_queries = OrderedDict()
+        self.seenlock = threading.Lock()
+        self.query_memory = 60.0
+
+        # runs query processing and sends queries on to neighbors, each
+        # send taking at most fanout_timeout seconds
+        self.fanout = ThreadPoolExecutor(max_workers=16,
+                                         thread_name_prefix='btfanout')
+        self.fanout_timeout = 5.0
 
         self.addrouter(self.__router)
 
-        self.addhandler(PING, self.__handle_ping)
-        self.addhandler(PEERNAME, self.__handle_peername)
-        self.addhandler(LISTPEERS, self.__handle_listpeers)
+        self.addhandler(PING, self.__handle_ping, blocking=False)
+        self.addhandler(PEERNAME, self.__handle_peername, blocking=False)
+        self.addhandler(LISTPEERS, self.__handle_listpeers, blocking=False)
         self.addhandler(INSERTPEER, self.__handle_insertpeer)
-        self.addhandler(QUERY, self.__handle_query)
-        self.addhandler(QRESPONSE, self.__handle_qresponse)
+        self.addhandler(QUERY, self.__handle_query, blocking=False)
+        self.addhandler(QRESPONSE, self.__handle_qresponse, blocking=False)
         self.addhandler(INFER, self.__handle_infer)
+        self.addstreamhandler(INFER, self.__handle_infer_stream)
+        self.addstreamhandler(INFERBINARY, self.__handle_infer_binary)
         self.addhandler(PEERQUIT, self.__handle_peerquit)
+        self.addhandler(STATS, self.__handle_stats, blocking=False)
+        self.addhandler(FETCH, self.__handle_fetch)
+        if self.workers is not None:
+            # transfers hold a worker for as long as they take, so a few of
+            # them must not leave none for inference
+            self.workers.maxrunning[FETCH] = 2
 
     def __debug(self, msg):
         if self.debug:
             btdebug(msg)
 
+    def __deadline(self, options):
+        """
+        Returns the local time.monotonic() deadline given by the
+        "deadline=milliseconds-left" option of a message, if it has one.
+        """
+
+        if 'deadline' not in options:
+            return None
+        return time.monotonic() + int(options['deadline']) / 1000
+
+    def __deadline_option(self, deadline):
+        """Formats the time left until deadline as a message option."""
+
+        if deadline is None:
+            return ''
+        return ' deadline=%d' % max(0, (deadline - time.monotonic()) * 1000)
+
+    def __timeleft(self, deadline):
+        return None if deadline is None else deadline - time.monotonic()
+
+    def __firstseen(self, key):
+        """
+        Returns whether key (a query id) is new, i.e. not seen within the
+        last self.query_memory seconds, and remembers it.
+        """
+
+        now = time.monotonic()
+        with self.seenlock:
+            while self.seen_queries:
+                oldest, expiry = next(iter(self.seen_queries.items()))
+                if expiry > now:
+                    break
+                del self.seen_queries[oldest]
+
+            if key in self.seen_queries:
+                return False
+            self.seen_queries[key] = now + self.query_memory
+            return True
+
     def __router(self, peerid):
-        if peerid not in self.getpeerids():
+        addr = self.peers.get(peerid)
+        if addr is None:
             return (None, None, None)
         else:
-            host, port = self.peers[peerid]
+            host, port = addr
             return (peerid, host, port)
 
     def __handle_ping(self, peerconn, data):
@@ -82,18 +397,78 @@ class MLPeer(BTPeer):
 
         peerconn.senddata(REPLY, self.myid)
 
+    def __handle_stats(self, peerconn, data):
+        """
+        Handles the STATS message type. The message data may be "text" to
+        get the metrics one per line instead of as a JSON object.
+        """
+
+        if data.strip() == 'text':
+            peerconn.senddata(REPLY, self.metrics.totext())
+        else:
+            peerconn.senddata(REPLY, self.metrics.tojson())
+
+    def __handle_fetch(self, peerconn, data):
+        """
+        Handles the FETCH message type. The message data should be a
+        string of the form, "model-name [offset=n] [digest=hex]". The
+        reply is "size digest offset filename": the size and SHA-256
+        digest of the file the model was loaded from, the offset from
+        which it is sent and its name, followed by the file's bytes from
+        that offset on, streamed in chunks. The file is sent from the
+        given offset only if its digest is the given one, so a transfer
+        that broke off can be resumed; otherwise it is sent in full.
+        """
+
+        try:
+            modelname, *options = data.split()
+            options = dict(option.split('=', 1) for option in options)
+            offset = int(options.get('offset', 0))
+        except:
+            self.__debug('invalid fetch %s: %s' % (str(peerconn), data))
+            peerconn.senddata(ERROR, 'Ftch: incorrect arguments')
+            return
+
+        path = self.models.source(modelname)
+        if modelname not in self.models or path is None or not os.path.isfile(path):
+            self.__debug('no file for model %s' % modelname)
+            peerconn.senddata(ERROR, 'Model not found')
+            return
+
+        with open(path, 'rb') as f:
+            size, digest = self.__artifact_digest(f)
+            if options.get('digest') != digest or not 0 <= offset <= size:
+                offset = 0
+            peerconn.senddata(REPLY, '%d %s %d %s' % (size, digest, offset,
+                                                      os.path.basename(path)))
+            if peerconn.sendfile(FETCH, f, offset, size - offset):
+                self.metrics.count('fetch_bytes_out', modelname, size - offset)
+
+    def __artifact_digest(self, f):
+        """Returns the size and SHA-256 digest of an open model file, hashing it only if it changed."""
+
+        stat = os.fstat(f.fileno())
+        with self.digestlock:
+            known = self.artifact_digests.get(f.name)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return stat.st_size, known[2]
+
+        sha256 = hashlib.sha256()
+        for data in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(data)
+        with self.digestlock:
+            self.artifact_digests[f.name] = (stat.st_size, stat.st_mtime_ns,
+                                             sha256.hexdigest())
+        return stat.st_size, sha256.hexdigest()
+
     def __handle_listpeers(self, peerconn, data):
         """Handles the LISTPEERS message type. Message data is not used."""
 
-        self.peerlock.acquire()
-        try:
-            self.__debug('Listing peers, total %d' % self.numberofpeers())
-            peerconn.senddata(REPLY, '%d' % self.numberofpeers())
-            for peerid in self.getpeerids():
-                host, port = self.peers[peerid]
-                peerconn.senddata(REPLY, '%s %s %d' % (peerid, host, port))
-        finally:
-            self.peerlock.release()
+        peers = self.peers.snapshot   # consistent view, no lock while sending
+        self.__debug('Listing peers, total %d' % len(peers))
+        peerconn.senddata(REPLY, '%d' % len(peers))
+        for peerid, (host, port) in peers.items():
+            peerconn.senddata(REPLY, '%s %s %d' % (peerid, host, port))
 
     def __handle_insertpeer(self, peerconn, data):
         """
@@ -119,28 +494,37 @@ class MLPeer(BTPeer):
 
         self.peerlock.acquire()
         try:
-            if self.addpeer(peerid, host, port):
-                self.__debug('added peer: %s' % peerid)
-                peerconn.senddata(REPLY, 'Join: peer added: %s (%s:%d)' % (
-                    peerid, host, int(port)))
-            else:
-                peerconn.senddata(
-                    ERROR, 'Join: peer already inserted or is self %s' % peerid)
+            added = self.addpeer(peerid, host, port)
         finally:
             self.peerlock.release()
 
+        # reply with the lock released, the reply may wait on a slow peer
+        if added:
+            self.__debug('added peer: %s' % peerid)
+            peerconn.senddata(REPLY, 'Join: peer added: %s (%s:%d)' % (
+                peerid, host, int(port)))
+        else:
+            peerconn.senddata(
+                ERROR, 'Join: peer already inserted or is self %s' % peerid)
+
     def __handle_query(self, peerconn, data):
         """
         Handles the QUERY message type. The message data should be in the
         format of a string, "return-peer-id return-peer-host return-peer-port
-        modelname ttl", where return-peer-id is the name of the peer that
-        initiated the query, modelname is the name of the model
-        being searched for, and ttl is how many further levels of peers
-        this query should be propagated on.
+        modelname ttl [deadline=ms] [qid=id]", where return-peer-id is the
+        name of the peer that initiated the query, modelname is the name of
+        the model being searched for, ttl is how many further levels of
+        peers this query should be propagated on, the optional deadline is
+        how many milliseconds the initiator is still waiting for an answer,
+        and the optional qid uniquely identifies the query so that copies
+        of it arriving over other paths are dropped.
         """
 
         try:
-            peerid, host, port, modelname, ttl = data.split()
+            peerid, host, port, modelname, ttl, *options = data.split()
+            options = dict(option.split('=', 1) for option in options)
+            deadline = self.__deadline(options)
+            ttl = int(ttl)
         except:
             self.__debug('invalid query %s: %s' % (str(peerconn), data))
             peerconn.senddata(ERROR, 'Quer: incorrect arguments')
@@ -148,67 +532,117 @@ class MLPeer(BTPeer):
 
         peerconn.senddata(REPLY, 'Query ACK: %s' % modelname)
 
-        t = threading.Thread(target=self.__processquery,
-                             args=[peerid, host, port, modelname, int(ttl)])
-        t.start()
+        qid = options.get('qid')
+        if qid is not None and not self.__firstseen(qid):
+            self.__debug('dropping duplicate query %s for %s' %
+                         (qid, modelname))
+            self.metrics.count('duplicate_queries', QUERY)
+            return
 
-    def __processquery(self, peerid, host, port, modelname, ttl):
+        self.fanout.submit(self.__processquery, peerid, host, port,
+                           modelname, ttl, deadline, qid)
+
+    def __processquery(self, peerid, host, port, modelname, ttl, deadline=None, qid=None):
         """
         Handles the processing of a query message after it has been
         received and acknowledged, by either replying with a QRESPONSE message
         if the model is in self.model_map, or propagating the message onto
-        all immediate neighbors.
+        all immediate neighbors in parallel. A query whose deadline has
+        passed is dropped, and the time left is passed on with it, as is
+        its id.
         """
 
-        if modelname in self.model_map:
-            mpeerid, mpeerhost, mpeerport = self.model_map[modelname]
+        if deadline is not None and time.monotonic() >= deadline:
+            self.__debug('dropping expired query for %s' % modelname)
+            return
+
+        location = self.model_map.get(modelname)
+        if location is not None:
+            mpeerid, mpeerhost, mpeerport = location
             if mpeerid is None:     # own models mapped to None
                 mpeerid = self.myid
 
             # can't use sendtopeer here because peerid is not necessarily
             # an immediate neighbor
-            self.connectandsend(host, port, QRESPONSE, '%s %s %s %d' % (
-                modelname, mpeerid, mpeerhost, mpeerport), peerid, False)
+            self.connectandsend(host, port, QRESPONSE, '%s %s %s %d%s' % (
+                modelname, mpeerid, mpeerhost, mpeerport,
+                '' if qid is None else ' ' + qid), peerid, False,
+                self.__timeleft(deadline))
             return
 
         # will only reach here if modelname not found... in which case
         # propagate query to neighbors
         if ttl > 0:
-            msgdata = '%s %s %s %s %d' % (
-                peerid, host, port, modelname, ttl - 1)
-            for nextpeerid in self.getpeerids():
-                if nextpeerid != peerid:
-                    self.sendtopeer(nextpeerid, QUERY, msgdata, False)
+            msgdata = '%s %s %s %s %d%s%s' % (
+                peerid, host, port, modelname, ttl - 1,
+                self.__deadline_option(deadline),
+                '' if qid is None else ' qid=%s' % qid)
+            self.__sendtoall([nextpeerid for nextpeerid in self.getpeerids()
+                              if nextpeerid != peerid], QUERY, msgdata, deadline)
+
+    def __sendtoall(self, peerids, msgtype, msgdata, deadline=None):
+        """
+        Sends a message, without waiting for replies, to each of the peers
+        at the same time from the fanout pool, so that a slow or dead peer
+        does not hold up the others. Each send is abandoned after
+        self.fanout_timeout seconds or at deadline, whichever comes first.
+        Returns the futures of the sends.
+        """
+
+        timeout = self.fanout_timeout
+        timeleft = self.__timeleft(deadline)
+        if timeleft is not None:
+            if timeleft <= 0:
+                return []
+            timeout = timeleft if timeout is None else min(timeout, timeleft)
+
+        return [self.fanout.submit(self.sendtopeer, peerid, msgtype, msgdata,
+                                   False, timeout)
+                for peerid in peerids]
 
     def __handle_qresponse(self, peerconn, data):
         """
         Handles the QRESPONSE message type. The message data should be
-        in the format of a string, "modelname peerid host port",
-        where modelname is the model that was queried about and peerid is
-        the name of a peer capable of serving inference for that model.
+        in the format of a string, "modelname peerid host port [qid]",
+        where modelname is the model that was queried about, peerid is
+        the name of a peer capable of serving inference for that model and
+        qid is the id of the query answered, if it had one; a peer's
+        response to a query is only considered once. Every peer that
+        responds is added as a replica of the model.
         """
         try:
-            modelname, mpeerid, host, port = data.split()
+            modelname, mpeerid, host, port, *qid = data.split()
         except:
             self.__debug('invalid qresponse %s: %s' % (str(peerconn), data))
             peerconn.senddata(ERROR, 'Resp: incorrect arguments')
             return
 
-        if modelname in self.model_map:
-            self.__debug("can't add duplicate model %s %s" %
-                         (modelname, mpeerid))
-        else:
+        if qid and not self.__firstseen('resp:%s:%s' % (qid[0], mpeerid)):
+            self.__debug('dropping duplicate response to query %s' % qid[0])
+            self.metrics.count('duplicate_queries', QRESPONSE)
+        elif mpeerid == self.myid:
+            self.__debug('ignoring response about own model %s' % modelname)
+        else:   # new replica, or renews a known one
             self.add_model(modelname, mpeerid, host, port)
 
     def __handle_infer(self, peerconn, data):
         """
         Handles the INFER message type. The message data should be in
-        the format of a string, "modelname input", where modelname is the name
-        of the model to be used.
+        the format of a string, "modelname [deadline=ms] input", where
+        modelname is the name of the model to be used and the optional
+        deadline is how many milliseconds the client is still waiting for
+        the result; the request is dropped if that has passed.
         """
 
         try:
             modelname, input = data.split(maxsplit=1)
+            options = {}
+            match = OPTION.match(input)
+            while match:
+                options[match[1]] = match[2]
+                input = input[match.end():]
+                match = OPTION.match(input)
+            deadline = self.__deadline(options)
         except:
             self.__debug('invalid infer %s: %s' % (str(peerconn), data))
             peerconn.senddata(ERROR, 'Infr: incorrect arguments')
@@ -219,12 +653,21 @@ class MLPeer(BTPeer):
             peerconn.senddata(ERROR, 'Model not found')
             return
 
+        if deadline is not None and time.monotonic() >= deadline:
+            self.__debug('dropping expired inference for %s' % modelname)
+            peerconn.senddata(ERROR, 'Infr: deadline exceeded')
+            return
+
         try:
-            model = self.models[modelname]
             X = json.loads(input)
-            Y_pred = model.predict(X)
+            start = time.monotonic()
+            Y_pred = self.__predict(modelname, X)
+            self.metrics.observe('predict_seconds', modelname,
+                                 time.monotonic() - start)
+            self.metrics.count('predict_rows', modelname, len(X))
             output = json.dumps(Y_pred.tolist())
         except Exception as e:
+            self.metrics.count('predict_errors', modelname)
             peerconn.senddata(ERROR, 'Error running inference: %s' % type(e))
             if self.debug:
                 traceback.print_exc()
@@ -232,6 +675,113 @@ class MLPeer(BTPeer):
 
         peerconn.senddata(REPLY, output)
 
+    def __predict(self, modelname, X):
+        """
+        Runs a loaded model on X, through the result cache and the
+        model's batcher if they are enabled.
+        """
+
+        batcher = self.batchers.get(modelname)
+        predict = batcher.predict if batcher else \
+            lambda X: self.__run_model(modelname, X)
+        if self.result_cache is None:
+            return predict(X)
+        return self.result_cache.predict(
+            modelname, self.models.version(modelname), X, predict)
+
+    def __run_model(self, modelname, X):
+        if self.process_pool is not None:
+            return self.process_pool.predict(modelname, X)
+        return self.models[modelname].predict(X)
+
+    def __handle_infer_binary(self, peerconn, chunks):
+        """
+        Handles the INFERBINARY message type. The message data should be
+        an array encoded with encode_tensor whose header is
+        "modelname [deadline=ms]", as for INFER. The predictions are sent
+        back encoded the same way, without a header.
+        """
+
+        chunks = list(chunks)
+        try:
+            data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+            (modelname, *options), X = decode_tensor(data)
+            deadline = self.__deadline(
+                dict(option.split('=', 1) for option in options))
+        except:
+            self.__debug('invalid binary infer %s' % str(peerconn))
+            peerconn.senddata(ERROR, 'Infb: incorrect arguments')
+            return
+
+        if modelname not in self.models:
+            self.__debug('model not found %s' % modelname)
+            peerconn.senddata(ERROR, 'Model not found')
+            return
+
+        if deadline is not None and time.monotonic() >= deadline:
+            self.__debug('dropping expired inference for %s' % modelname)
+            peerconn.senddata(ERROR, 'Infb: deadline exceeded')
+            return
+
+        try:
+            start = time.monotonic()
+            Y_pred = self.__predict(modelname, X)
+            self.metrics.observe('predict_seconds', modelname,
+                                 time.monotonic() - start)
+            self.metrics.count('predict_rows', modelname, len(X))
+            output = encode_tensor('', Y_pred)
+        except Exception as e:
+            self.metrics.count('predict_errors', modelname)
+            peerconn.senddata(ERROR, 'Error running inference: %s' % type(e))
+            if self.debug:
+                traceback.print_exc()
+            return
+
+        peerconn.senddata(REPLY, output)
+
+    def __handle_infer_stream(self, peerconn, chunks):
+        """
+        Handles a streamed INFER message. The first chunk is
+        "modelname [deadline=ms]" and every following chunk a JSON list of
+        input rows. The predictions for each chunk are streamed back as a JSON
+        list as soon as that chunk has been processed, so memory use is
+        bounded by the chunk size rather than by the size of the whole batch.
+        The stream is cut off once the deadline, if any, has passed. Each
+        chunk is run like an INFER message, through the result cache,
+        batcher and process pool if they are enabled.
+        """
+
+        chunks = iter(chunks)
+        try:
+            modelname, *options = str(next(chunks), 'utf-8').split()
+            deadline = self.__deadline(
+                dict(option.split('=', 1) for option in options))
+        except:
+            self.__debug('invalid infer stream %s' % str(peerconn))
+            peerconn.senddata(ERROR, 'Infr: incorrect arguments')
+            return
+
+        if modelname not in self.models:
+            self.__debug('model not found %s' % modelname)
+            peerconn.senddata(ERROR, 'Model not found')
+            return
+
+        def predictions():
+            for chunk in chunks:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError('deadline exceeded')
+                X = json.loads(str(chunk, 'utf-8'))
+                start = time.monotonic()
+                Y_pred = self.__predict(modelname, X)
+                self.metrics.observe('predict_seconds', modelname,
+                                     time.monotonic() - start)
+                self.metrics.count('predict_rows', modelname, len(X))
+                yield json.dumps(Y_pred.tolist())
+
+        if not peerconn.sendstream(REPLY, predictions()):
+            self.metrics.count('predict_errors', modelname)
+            self.__debug('error streaming inference for %s' % modelname)
+
     def __handle_peerquit(self, peerconn, data):
         """
         Handles the QUIT message type. The message data should be in the
@@ -240,150 +790,503 @@ class MLPeer(BTPeer):
         peer's directory.
         """
 
+        peerid = data
         self.peerlock.acquire()
         try:
-            peerid = data
-            if peerid in self.getpeerids():
+            removed = peerid in self.getpeerids()
+            if removed:
                 self.removepeer(peerid)
-                msg = 'Quit: peer removed: %s' % peerid
-                self.__debug(msg)
-                peerconn.senddata(REPLY, msg)
-            else:
-                msg = 'Quit: peer not found: %s' % peerid
-                self.__debug(msg)
-                peerconn.senddata(ERROR, msg)
         finally:
             self.peerlock.release()
 
-    # precondition: may be a good idea to hold the lock before going
-    #               into this function
-    def buildpeers(self, host, port, hops=1):
+        # reply with the lock released, the reply may wait on a slow peer
+        if removed:
+            msg = 'Quit: peer removed: %s' % peerid
+            self.__debug(msg)
+            peerconn.senddata(REPLY, msg)
+        else:
+            msg = 'Quit: peer not found: %s' % peerid
+            self.__debug(msg)
+            peerconn.senddata(ERROR, msg)
+
+    # precondition: peerlock must not be held, the peers are added from
+    #               other threads while this function waits for them
+    def buildpeers(self, host, port, hops=1, timeout=None, maxparallel=8):
         """
-        buildpeers(host, port, hops)
+        buildpeers(host, port, hops, timeout, maxparallel)
 
         Attempts to build the local peer list up to the limit stored by
-        self.maxpeers, using a simple depth-first search given an
-        initial host and port as starting point. The depth of the
-        search is limited by the hops parameter.
+        self.maxpeers, using a breadth-first search given an initial host
+        and port as starting point. The depth of the search is limited by
+        the hops parameter. Each level is contacted in parallel, at most
+        maxparallel peers at a time and each exchange taking at most
+        timeout seconds (self.fanout_timeout by default), so the search
+        takes time in proportion to hops rather than to the number of
+        peers. Every host and port is contacted once. The peers of a level
+        that answer fastest are joined first, and those are the ones
+        kept when there is not room for all of them.
         """
 
-        if self.maxpeersreached() or not hops:
-            return
-
-        peerid = None
+        if timeout is None:
+            timeout = self.fanout_timeout
+        frontier = [(host, int(port))]
+        visited = {(host, int(port)), (self.serverhost, self.serverport)}
+
+        with ThreadPoolExecutor(max_workers=maxparallel,
+                                thread_name_prefix='btbuild') as executor:
+            for level in range(hops):
+                if not frontier or self.maxpeersreached():
+                    return
+                if self.maxpeers > 0:   # no need to probe many more than there is room for
+                    frontier = frontier[:max(maxparallel,
+                                             4 * (self.maxpeers - self.numberofpeers()))]
+                self.__debug('Building peers from %d hosts, %d hops left' %
+                             (len(frontier), hops - level))
+
+                # ask every host for its name, timing the round trip
+                contacts = [contact for contact in
+                            executor.map(lambda addr: self.__probepeer(*addr, timeout), frontier)
+                            if contact is not None and contact[1] != self.myid]
+                contacts.sort()
+                if self.maxpeers > 0:
+                    # only as many new peers as there is room for, known
+                    # ones still being listed
+                    room = self.maxpeers - self.numberofpeers()
+                    new = [contact for contact in contacts if contact[1] not in self.peers]
+                    contacts = new[:room] + [contact for contact in contacts
+                                             if contact[1] in self.peers]
+
+                # join the fastest first, and list their peers for the next level
+                listing = level + 1 < hops
+                frontier = []
+                for neighbors in executor.map(
+                        lambda contact: self.__joinpeer(*contact[1:], timeout, listing),
+                        contacts):
+                    for addr in neighbors:
+                        if addr not in visited:
+                            visited.add(addr)
+                            frontier.append(addr)
+
+    def __probepeer(self, host, port, timeout):
+        """Returns (round trip seconds, peerid, host, port) for a peer that answers PEERNAME, else None."""
+
+        start = time.monotonic()
+        try:
+            reply = self.connectandsend(host, port, PEERNAME, '', timeout=timeout)
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return None
+        if not reply or reply[0][0] != REPLY:
+            return None
+        rtt = time.monotonic() - start
+        self.__debug('contacted %s in %.3f s' % (reply[0][1], rtt))
+        return (rtt, reply[0][1], host, port)
+
+    def __joinpeer(self, peerid, host, port, timeout, listing):
+        """
+        Joins a peer found by __probepeer, unless it is this peer or
+        there is no room for it, and returns the (host, port) of its peers
+        if listing is set.
+        """
 
-        self.__debug('Building peers from (%s:%s)' % (host, port))
+        if peerid == self.myid:
+            return []
 
+        added = False
         try:
-            reply = self.connectandsend(host, port, PEERNAME, '')
-            if not reply:
-                return
-
-            _, peerid = reply[0]
-            self.__debug('contacted ' + peerid)
-
-            self.connectandsend(host, port, INSERTPEER, '%s %s %d' % (
-                self.myid, self.serverhost, self.serverport), peerid)[0]
-
-            self.addpeer(peerid, host, port)
-
-            if not self.maxpeersreached() and hops > 1:
-                # do recursive depth first search to add more peers
-                msgreply = self.connectandsend(
-                    host, port, LISTPEERS, '', peerid)
-                if len(msgreply) > 1:
-                    for reply in msgreply[1:]:  # get rid of header count reply
-                        nextpeerid, nextpeerhost, nextpeerport = reply[1].split(
-                        )
-                        if nextpeerid != self.myid:
-                            self.buildpeers(
-                                nextpeerhost, nextpeerport, hops - 1)
-                            if self.maxpeersreached():
-                                return
+            if peerid not in self.peers and not self.maxpeersreached():
+                reply = self.connectandsend(host, port, INSERTPEER, '%s %s %d' % (
+                    self.myid, self.serverhost, self.serverport), peerid, timeout=timeout)
+                if not reply:
+                    return []
+                added = self.addpeer(peerid, host, port)
+
+            if not listing or self.maxpeersreached():
+                return []
+            neighbors = []
+            for reply in self.connectandsend(host, port, LISTPEERS, '', peerid,
+                                             timeout=timeout)[1:]:  # get rid of header count reply
+                nextpeerid, nextpeerhost, nextpeerport = reply[1].split()
+                if nextpeerid != self.myid:
+                    neighbors.append((nextpeerhost, int(nextpeerport)))
+            return neighbors
         except:
             if self.debug:
                 traceback.print_exc()
-            self.removepeer(peerid)
+            if added:
+                self.removepeer(peerid)
+            return []
 
     def stabilize(self):
         todelete = self.checklivepeers()
-        models_todelete = list(
-            filter(lambda t: t[1][0] in todelete, self.model_map.items()))
 
         self.peerlock.acquire()
         try:
             for peerid in todelete:
-                self.removepeer(peerid)
+                for model_name in self.removepeer(peerid):
+                    self.model_map.discard(model_name, peerid=peerid)
+        finally:
+            self.peerlock.release()
 
-            for model_name, _ in models_todelete:
-                if model_name in self.model_map:
-                    del self.model_map[model_name]
+        self.model_map.purge()
+
+    def __refresh_model(self, model_name):
+        self.__debug('refreshing location of %s' % model_name)
+        self.query_model(model_name, self.query_ttl)
+
+    def __forget_model(self, model_name, host, port):
+        """
+        Drops the replica of a model at host:port, e.g. after that peer
+        said it does not have the model (any more).
+        """
+
+        self.peerlock.acquire()
+        try:
+            for peerid, _, _ in self.model_map.discard(model_name, host, int(port)):
+                if peerid is not None:
+                    self.peers.withdraw(peerid, model_name)
+                self.__debug('forgot stale location of %s' % model_name)
         finally:
             self.peerlock.release()
 
+    def locate_model(self, model_name, ttl=None, timeout=2.0):
+        """
+        locate_model(model name, ttl, timeout) -> (peerid, host, port) or None
+
+        Returns where the model is served, from self.model_map if it is
+        there, otherwise querying for it (ttl levels deep, self.query_ttl
+        by default) and waiting at most timeout seconds for a response.
+        A model that could not be found is not queried for again until
+        the negative result expires. The peer id is None for own models.
+        """
+
+        location = self.model_map.lookup(model_name)
+        if location is not None or self.model_map.isnegative(model_name):
+            return location
+
+        self.query_model(model_name, self.query_ttl if ttl is None else ttl,
+                         timeout)
+        location = self.model_map.wait(model_name, timeout)
+        if location is None:
+            self.model_map.setnegative(model_name)
+        return location
+
+    def infer(self, model_name, X, timeout=None, retries=2):
+        """
+        infer(model name, input rows, timeout, retries) -> predictions
+
+        Runs inference wherever the model is served: locally if it is loaded
+        here, otherwise on one of its replicas (see locate_model), picked by
+        MLModelMap.choose from their measured latency, error rate and
+        requests in flight. A failed request is retried on another replica
+        up to retries times, and a replica that fails
+        self.max_replica_failures times in a row is dropped. Returns the
+        predictions as an array, or None if no replica could serve them
+        within timeout seconds (self.requesttimeout if not given).
+        """
+
+        if timeout is None:
+            timeout = self.requesttimeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if model_name in self.models:
+            return self.__predict(model_name, X)
+
+        if self.locate_model(model_name) is None:
+            return None
+
+        tried = []
+        for attempt in range(retries + 1):
+            replica = self.model_map.choose(model_name, tried)
+            timeleft = self.__timeleft(deadline)
+            if replica is None or (timeleft is not None and timeleft <= 0):
+                break
+            peerid, host, port = replica.location
+            tried.append(replica.location)
+            if attempt:
+                self.metrics.count('infer_retries', model_name)
+
+            start = time.monotonic()
+            self.model_map.begin(replica)
+            Y_pred = None
+            try:
+                Y_pred = self.connectandinfer(host, port, model_name, X,
+                                              peerid, timeleft)
+            finally:
+                self.model_map.end(replica, time.monotonic() - start,
+                                   Y_pred is not None)
+            if Y_pred is not None:
+                return Y_pred
+            if replica.failures >= self.max_replica_failures:
+                self.__forget_model(model_name, host, port)
+        return None
+
+    def query_model(self, model_name, ttl, timeout=None):
+        """
+        query_model(model name, ttl, timeout) -> query id
+
+        Floods a QUERY for the model to all immediate neighbors, to be
+        propagated ttl further levels; the peers that have the model answer
+        with a QRESPONSE, which adds it to self.model_map. The query gets a
+        fresh id so that every peer handles it only once, however many
+        paths it arrives over. If timeout is given, peers stop working on
+        the query after that many seconds.
+        """
+
+        qid = uuid.uuid4().hex
+        self.__firstseen(qid)   # don't handle it when it comes back here
+        deadline = None if timeout is None else time.monotonic() + timeout
+        msgdata = '%s %s %d %s %d%s qid=%s' % (
+            self.myid, self.serverhost, self.serverport, model_name, ttl,
+            self.__deadline_option(deadline), qid)
+        self.__sendtoall(self.getpeerids(), QUERY, msgdata, deadline)
+        return qid
+
+    def connectandinfer(self, host, port, modelname, X, peerid=None, timeout=None):
+        """
+        connectandinfer(host, port, model name, input rows, peer id, timeout) -> predictions
+
+        Sends an INFERBINARY request for the given model to host:port and
+        returns the predictions as an array, or None if the request failed.
+        Sending the input as raw array data avoids formatting and parsing
+        it as JSON on either side.
+        """
+
+        header = modelname
+        if timeout is not None:
+            header += ' deadline=%d' % (timeout * 1000)
+        for replytype, data in self.connectandsend(host, port, INFERBINARY,
+                                                   encode_tensor(header, X),
+                                                   peerid, True, timeout, raw=True):
+            if replytype == REPLY:
+                return decode_tensor(data)[1]
+            error = str(data, 'utf-8', 'replace')
+            self.__debug('binary infer on %s failed: %s' % (modelname, error))
+            if error == 'Model not found':
+                self.__forget_model(modelname, host, port)
+        return None
+
+    def fetch_model(self, model_name, host, port, path, peerid=None, timeout=10.0, job=None):
+        """
+        fetch_model(model name, host, port, path, peer id, timeout, job) -> path
+
+        Copies the file another peer loaded the model from to path with a
+        FETCH request, each send and receive taking at most timeout
+        seconds. The file is written to "path.digest.part" and moved to
+        path once its size and SHA-256 digest are checked. If the
+        transfer breaks off, the part written so far is kept, and the next
+        fetch of the same file, from any peer, resumes from there. Progress
+        is recorded in job (an MLLoadJob), if given. Raises IOError (or
+        ValueError, if the file does not match its digest) on failure.
+        """
+
+        directory, name = os.path.split(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        partial = [file for file in os.listdir(directory)
+                   if file.startswith(name + '.') and file.endswith('.part')]
+        digest, offset = '', 0
+        if partial:
+            digest = partial[0][len(name) + 1:-len('.part')]
+            offset = os.path.getsize(os.path.join(directory, partial[0]))
+
+        peerconn = BTPeerConnection(peerid, host, port, debug=self.debug,
+                                    timeout=timeout)
+        try:
+            peerconn.senddata(FETCH, '%s offset=%d digest=%s' %
+                              (model_name, offset, digest))
+            replytype, reply = peerconn.recvdata()
+            if replytype != REPLY:
+                raise IOError('fetch of %s from %s:%s failed: %s' %
+                              (model_name, host, port, reply))
+            size, digest, offset, _ = reply.split(' ', 3)
+            size, offset = int(size), int(offset)
+            partpath = '%s.%s.part' % (path, digest)
+            for file in partial:
+                if os.path.join(directory, file) != os.path.abspath(partpath):
+                    os.remove(os.path.join(directory, file))
+
+            if job is not None:
+                job.total = size
+                job.advance(offset)
+            if offset and (not os.path.exists(partpath) or
+                           os.path.getsize(partpath) < offset):
+                raise IOError('fetch of %s from %s:%s failed: bad offset %d' %
+                              (model_name, host, port, offset))
+            with open(partpath, 'r+b' if os.path.exists(partpath) else 'w+b') as f:
+                # hash what is already there, then the rest as it arrives
+                sha256 = hashlib.sha256()
+                for data in iter(lambda: f.read(min(1 << 20, offset - f.tell())), b''):
+                    sha256.update(data)
+                f.seek(offset)
+                f.truncate()
+
+                msgtype, chunks = peerconn.recvstream()
+                if msgtype != FETCH or not peerconn.streamed:
+                    raise IOError('fetch of %s from %s:%s failed: no data' %
+                                  (model_name, host, port))
+                try:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        if job is not None:
+                            job.advance(len(chunk))
+                except EOFError:
+                    raise IOError('fetch of %s from %s:%s broke off at %d of %d bytes' %
+                                  (model_name, host, port, f.tell(), size))
+                received = f.tell()
+        finally:
+            peerconn.close()
+
+        self.metrics.count('fetch_bytes_in', model_name, received - offset)
+        if received != size or sha256.hexdigest() != digest:
+            os.remove(partpath)
+            raise ValueError('fetched %s does not match its digest' % model_name)
+        os.replace(partpath, path)
+        return path
+
+    def load_model_from_peer(self, model_name, download_path, host=None, port=None, peerid=None, background=False):
+        """
+        Loads a model from a copy of the file another peer loaded it from
+        (see fetch_model), saved to download_path. If no peer is given,
+        the model's replicas are tried in turn, those that have answered
+        requests fastest first, after locating it if needed (see
+        locate_model). Returns the MLLoadJob, which has finished unless
+        background is set.
+        """
+
+        def fetch(job):
+            if host is not None:
+                return self.fetch_model(model_name, host, port, download_path,
+                                        peerid, job=job)
+
+            self.locate_model(model_name)
+            replicas = sorted((replica for replica in self.model_map.replicas(model_name)
+                               if replica.location[0] is not None),
+                              key=lambda replica: (replica.latency is None,
+                                                   replica.latency or 0.0))
+            error = IOError('no replica of %s found' % model_name)
+            for replica in replicas:
+                replicapeerid, replicahost, replicaport = replica.location
+                try:
+                    return self.fetch_model(model_name, replicahost, replicaport,
+                                            download_path, replicapeerid, job=job)
+                except (IOError, ValueError) as e:
+                    self.__debug('fetch from %s failed: %s' % (replicapeerid, e))
+                    error = e
+                    job.nbytes = 0
+            raise error
+
+        return self.loader.submit(model_name, 'peer', fetch, background)
+
+    def dump_stats(self, path=None, text=False):
+        """
+        Writes this peer's metrics (see BTPeerMetrics) as JSON, or one per
+        line if text is set, to the file at path or to standard output.
+        """
+
+        stats = self.metrics.totext() if text else self.metrics.tojson() + '\n'
+        if path is None:
+            print(stats, end='')
+        else:
+            with open(path, 'w') as f:
+                f.write(stats)
+
     def add_model(self, model_name, peerid, host, port):
-        """Adds a model to the self.model_map dictionary."""
+        """Adds a model, or another replica of it, to self.model_map."""
 
+        # no peerlock: this runs on the event loop for RESP, and both
+        # self.model_map and self.peers have locks of their own
         self.model_map[model_name] = (peerid, host, int(port))
+        if peerid is not None:
+            self.peers.advertise(peerid, model_name)
 
-    def load_model_from_path(self, model_name, path):
-        """Loads a model from a pickle file or from a directory that contains one."""
+    def load_model_from_path(self, model_name, path, background=False):
+        """
+        Loads a model from a pickle file or mapped model file (see
+        save_mapped_model), or from a directory that contains one,
+        preferring a mapped one. Tree ensembles are compiled (see
+        compile_model) unless self.models.compile is False. Returns the
+        MLLoadJob, which has finished unless background is set.
+        """
 
-        model_path = None
-        if os.path.isfile(path):
-            model_path = path
-        elif os.path.isdir(path):
-            for file in os.listdir(path):
-                if file.endswith('.pkl') or file.endswith('.pickle'):
-                    model_path = os.path.join(path, file)
-                    break
+        return self.loader.submit(model_name, 'path', lambda job: path, background)
 
-            if model_path is None:
-                self.__debug('no .pkl or .pickle file found in %s' % path)
-                return
-        else:
+    def __load_model_file(self, model_name, path):
+        """Loads a model as load_model_from_path describes; raises ValueError if it cannot."""
+
+        model_path = find_model_file(path)
+        if model_path is None and os.path.isdir(path):
+            self.__debug('no .pkl, .pickle or %s file found in %s' %
+                         (MAPPEDSUFFIX, path))
+            raise ValueError('no .pkl, .pickle or %s file found in %s' %
+                             (MAPPEDSUFFIX, path))
+        elif model_path is None:
             self.__debug('invalid path %s' % path)
-            return
+            raise ValueError('invalid path %s' % path)
 
         try:
-            with open(model_path, 'rb') as f:
-                self.models[model_name] = pickle.load(f)
-
-            self.model_map[model_name] = (
-                None, self.serverhost, self.serverport)
-        except pickle.UnpicklingError:
+            self.models.load(model_name, model_path)
+        except (pickle.UnpicklingError, ValueError, struct.error):
             self.__debug('error loading model from %s' % model_path)
+            raise ValueError('error loading model from %s' % model_path)
 
-    def load_model_from_Azure_ML(self, tenant_id, subscription_id, resource_group, workspace_name, model_name, model_version=None, download_path='.'):
-        """Loads a model from Azure Machine Learning."""
+        if self.result_cache is not None:
+            self.result_cache.invalidate(model_name)
+        self.model_map[model_name] = (None, self.serverhost, self.serverport)
 
-        try:
-            ws = MLClient(InteractiveBrowserCredential(tenant_id=tenant_id),
-                          subscription_id, resource_group, workspace_name)
+    def load_model_from_Azure_ML(self, tenant_id, subscription_id, resource_group, workspace_name, model_name, model_version=None, download_path='.', background=False):
+        """
+        Loads a model from Azure Machine Learning. Returns the MLLoadJob,
+        which has finished unless background is set.
+        """
+
+        def fetch(job):
+            ws = self.loader.azure_client(tenant_id, subscription_id,
+                                          resource_group, workspace_name)
 
-            if model_version is None:
-                model_version = max(    # get the latest model version
+            version = model_version
+            if version is None:
+                version = max(    # get the latest model version
                     [int(m.version) for m in ws.models.list(name=model_name)]
                 )
 
-            ws.models.download(model_name, model_version, download_path)
-
-            self.load_model_from_path(
-                model_name, os.path.join(download_path, model_name, ws.models.get(
-                    model_name, model_version).path.split('/')[-2]))
-            self.__debug('loaded model %s version %d from Azure ML' %
-                         (model_name, model_version))
-        except:
-            if self.debug:
-                traceback.print_exc()
-
-    def load_model_from_AWS_SageMaker(self, access_key, secret_key, region, model_name, download_path):
-        """Loads a model from AWS SageMaker."""
+            # look up where the model goes while it downloads
+            model = self.loader.streams.submit(ws.models.get, model_name, version)
+            cache = self.loader.cache
+            if cache is not None:
+                key = cache.key('azure', subscription_id, resource_group,
+                                workspace_name, model_name, version)
+                cached = cache.lookup(key)
+                if cached is not None:
+                    job.cached = True
+                    path = os.path.join(download_path, model_name,
+                                        model.result().path.split('/')[-2])
+                    cache.copyto(cached, os.path.join(path, cache.filename(key)))
+                    return path
+
+            ws.models.download(model_name, version, download_path)
+            self.__debug('fetched model %s version %s from Azure ML' %
+                         (model_name, version))
+            path = os.path.join(download_path, model_name,
+                                model.result().path.split('/')[-2])
+            if cache is not None and find_model_file(path) is not None:
+                cache.put(key, find_model_file(path))
+            return path
+
+        return self.loader.submit(model_name, 'Azure ML', fetch, background)
+
+    def load_model_from_AWS_SageMaker(self, access_key, secret_key, region, model_name, download_path, background=False):
+        """
+        Loads a model from AWS SageMaker, downloading it from S3 in ranges
+        fetched in parallel (see MLModelLoader). Returns the MLLoadJob,
+        which has finished unless background is set.
+        """
 
-        try:
-            session = boto3.session.Session(aws_access_key_id=access_key,
-                                            aws_secret_access_key=secret_key,
-                                            region_name=region)
+        def fetch(job):
+            session = self.loader.aws_session(aws_access_key_id=access_key,
+                                              aws_secret_access_key=secret_key,
+                                              region_name=region)
 
             sagemaker_client = session.client('sagemaker')
             response = sagemaker_client.describe_model(ModelName=model_name)
@@ -392,24 +1295,93 @@ class MLPeer(BTPeer):
                 's3://', '')
             bucket, key = url.split('/', maxsplit=1)
 
-            session.client('s3').download_file(bucket, key, download_path)
+            self.loader.download_s3(job, session.client('s3'), bucket, key,
+                                    download_path, model_name)
+            self.__debug('fetched model %s from AWS SageMaker' % model_name)
+            return download_path
 
-            self.load_model_from_path(model_name, download_path)
-            self.__debug('loaded model %s from AWS SageMaker' % model_name)
-        except:
-            if self.debug:
-                traceback.print_exc()
+        return self.loader.submit(model_name, 'AWS SageMaker', fetch, background)
+
+    def enable_batching(self, model_name, window=0.005, maxbatch=256):
+        """
+        Batches the INFER requests for a model: requests arriving within
+        window seconds of each other, up to maxbatch rows in all, are run
+        through a single predict call (see MLBatcher). Each request waits
+        at most about window seconds longer than it would otherwise. Only
+        requests running at the same time can be batched, so the worker
+        pool needs about as many workers as requests should be batched.
+        """
+
+        self.batchers[model_name] = MLBatcher(
+            lambda X: self.__run_model(model_name, X), window, maxbatch,
+            self.metrics, model_name)
+
+    def disable_batching(self, model_name):
+        """Runs the INFER requests for a model one by one again."""
+
+        self.batchers.pop(model_name, None)
+
+    def enable_result_cache(self, maxrows=100000, maxbytes=64 << 20):
+        """
+        Caches the predictions of loaded models row by row (see
+        MLResultCache), so that rows seen before are not predicted again
+        until they are evicted or their model is unloaded or reloaded.
+        """
+
+        self.result_cache = MLResultCache(maxrows, maxbytes, self.metrics)
+
+    def disable_result_cache(self):
+        self.result_cache = None
+
+    def enable_artifact_cache(self, root, maxbytes=None):
+        """
+        Keeps the models downloaded from the cloud in an MLArtifactCache
+        under root, of at most maxbytes bytes, so that loading the same
+        version again copies it from there instead of downloading it.
+        """
+
+        self.loader.cache = MLArtifactCache(root, maxbytes, self.metrics)
+
+    def disable_artifact_cache(self):
+        self.loader.cache = None
+
+    def enable_processes(self, processes=None):
+        """
+        Runs the models in a pool of worker processes (see MLProcessPool),
+        one per core by default, instead of in the threads handling the
+        requests, so that inference is not limited to one core by the GIL.
+        Use self.process_pool.pin to keep a model on some workers only.
+        """
+
+        if self.process_pool is None:
+            self.process_pool = MLProcessPool(self.models, processes, self.metrics)
+            self.models.dropped = self.process_pool.drop
+
+    def disable_processes(self):
+        pool, self.process_pool = self.process_pool, None
+        if pool is not None:
+            self.models.dropped = None
+            pool.shutdown()
 
     def unload_model(self, model_name):
         """Unloads a model."""
 
         if model_name in self.models:
             del self.models[model_name]
+            self.batchers.pop(model_name, None)
+            if self.result_cache is not None:
+                self.result_cache.invalidate(model_name)
             self.__debug('unloaded %s from server' % model_name)
 
-        if model_name in self.model_map:
-            del self.model_map[model_name]
-            self.__debug('unloaded %s' % model_name)
+        self.peerlock.acquire()
+        try:
+            for replica in self.model_map.replicas(model_name):
+                if replica.location[0] is not None:
+                    self.peers.withdraw(replica.location[0], model_name)
+            if self.model_map.pop(model_name, None) is not None:
+                self.__debug('unloaded %s' % model_name)
+        finally:
+            self.peerlock.release()
 
     def query_data_in_Azure_Data_Explorer(self, cluster_uri, database, query):
         """Sends the query to Azure Data Explorer."""
@@ -431,3 +1403,1697 @@ class MLPeer(BTPeer):
                 traceback.print_exc()
 
         return result
+
+
+class MLReplica:
+    """
+    One peer serving a model, as known to MLModelMap: its location and
+    what requests to it have shown so far.
+    """
+
+    def __init__(self, location, expires):
+        self.location = location    # (peerid, host, port)
+        self.expires = expires      # time.monotonic(), or None for own models
+        self.inflight = 0           # requests sent and not yet answered
+        self.latency = None         # moving average of seconds per request
+        self.errorrate = 0.0        # moving average of failed requests
+        self.failures = 0           # failed requests since the last success
+
+    def score(self):
+        """Returns the expected cost of sending it a request: lower is better."""
+
+        latency = 0.001 if self.latency is None else self.latency
+        return (self.inflight + 1) * latency / max(0.01, 1.0 - self.errorrate)
+
+
+class MLModelMap:
+    """
+    Caches where models are served: for each model name, the replicas
+    (MLReplica) known to serve it, by host and port. Own models (peerid
+    None) stay until removed; the locations of other peers' models expire
+    after expiry seconds, so a peer that unloaded a model is not routed to
+    for ever. A model that is looked up at least hot times after it was
+    last stored and whose replicas are all within refresh_ahead (a
+    fraction of expiry) of expiring has refresh(model name) called once,
+    so that fresh locations can arrive before the old ones expire. That a
+    model could not be found is remembered for negative_expiry seconds.
+    Hits, misses, expiries and so on are counted in metrics, if given.
+
+    Used as a dictionary it maps each model name to a single location,
+    an own one if there is one. Reading with "in", get and items neither
+    counts nor refreshes; lookup and [] do.
+    """
+
+    def __init__(self, expiry=300.0, negative_expiry=10.0, refresh_ahead=0.2, hot=2, metrics=None, refresh=None):
+        self.expiry = expiry
+        self.negative_expiry = negative_expiry
+        self.refresh_ahead = refresh_ahead
+        self.hot = hot
+        self.metrics = metrics
+        self.refresh = refresh
+
+        self.cond = threading.Condition(threading.RLock())
+        self.entries = {}   # model name ==> [{(host, port) ==> MLReplica}, hits, refreshing]
+        self.negative = {}  # model name ==> expires
+
+    def __count(self, event):
+        if self.metrics is not None:
+            self.metrics.count('model_map', event)
+
+    def __live(self, name, now):
+        """
+        Returns the entry for name, dropping its expired replicas first
+        and the entry too if none are left.
+        """
+
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+
+        replicas = entry[0]
+        for key in [key for key, replica in replicas.items()
+                    if replica.expires is not None and replica.expires <= now]:
+            del replicas[key]
+            self.__count('expired')
+        if not replicas:
+            del self.entries[name]
+            return None
+        return entry
+
+    def __preferred(self, entry):
+        replicas = list(entry[0].values())
+        for replica in replicas:
+            if replica.location[0] is None:
+                return replica.location
+        return replicas[0].location
+
+    def lookup(self, name):
+        """
+        lookup(model name) -> (peerid, host, port) or None
+
+        Returns a location of the model, if known, and starts refreshing
+        it if it is hot and about to expire.
+        """
+
+        now = time.monotonic()
+        refresh = False
+        with self.cond:
+            entry = self.__live(name, now)
+            if entry is None:
+                self.__count('miss')
+                return None
+
+            self.__count('hit')
+            entry[1] += 1
+            expires = [replica.expires for replica in entry[0].values()]
+            if None not in expires and not entry[2] and entry[1] >= self.hot \
+                    and max(expires) - now <= self.refresh_ahead * self.expiry:
+                entry[2] = refresh = True
+            location = self.__preferred(entry)
+
+        if refresh and self.refresh is not None:
+            self.__count('refresh')
+            self.refresh(name)
+        return location
+
+    def replicas(self, name):
+        """Returns the live replicas (MLReplica) of the model."""
+
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            return [] if entry is None else list(entry[0].values())
+
+    def choose(self, name, exclude=()):
+        """
+        choose(model name, locations to skip) -> MLReplica or None
+
+        Picks a replica of the model to send a request to by the power of
+        two choices: the better scoring (see MLReplica.score) of two
+        chosen at random, which spreads load almost as well as always
+        taking the best without all clients piling onto the same one.
+        """
+
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            if entry is None:
+                return None
+            candidates = [replica for replica in entry[0].values()
+                          if replica.location not in exclude]
+            if len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            return min(candidates, key=MLReplica.score, default=None)
+
+    def begin(self, replica):
+        """Records that a request is being sent to replica."""
+
+        with self.cond:
+            replica.inflight += 1
+
+    def end(self, replica, seconds, ok):
+        """Records that a request to replica took seconds and whether it succeeded."""
+
+        with self.cond:
+            replica.inflight -= 1
+            if ok:
+                replica.latency = seconds if replica.latency is None \
+                    else 0.8 * replica.latency + 0.2 * seconds
+            replica.errorrate = 0.8 * replica.errorrate + (0.0 if ok else 0.2)
+            replica.failures = 0 if ok else replica.failures + 1
+
+    def wait(self, name, timeout):
+        """Waits at most timeout seconds for the model to be stored and returns a location of it, or None."""
+
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                entry = self.__live(name, now)
+                if entry is not None or now >= deadline:
+                    return self.__preferred(entry) if entry else None
+                self.cond.wait(deadline - now)
+
+    def isnegative(self, name):
+        """Returns whether the model was recently looked for and not found."""
+
+        with self.cond:
+            expires = self.negative.get(name)
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.negative[name]
+                return False
+            self.__count('negative_hit')
+            return True
+
+    def setnegative(self, name):
+        with self.cond:
+            self.negative[name] = time.monotonic() + self.negative_expiry
+        self.__count('negative')
+
+    def discard(self, name, host=None, port=None, peerid=None):
+        """
+        Removes the replica of the model at host:port, or those of the
+        peer peerid. Returns the locations removed.
+        """
+
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            if entry is None:
+                return []
+            removed = []
+            for key, replica in list(entry[0].items()):
+                if key == (host, port) or \
+                        (peerid is not None and replica.location[0] == peerid):
+                    removed.append(entry[0].pop(key).location)
+            if not entry[0]:
+                del self.entries[name]
+            return removed
+
+    def purge(self):
+        """Drops all expired replicas."""
+
+        now = time.monotonic()
+        with self.cond:
+            for name in list(self.entries):
+                self.__live(name, now)
+            self.negative = {name: expires for name, expires
+                             in self.negative.items() if expires > now}
+
+    def __setitem__(self, name, location):
+        """Adds the location as a replica of the model, or renews it."""
+
+        peerid, host, port = location
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            if entry is None:
+                entry = self.entries[name] = [{}, 0, False]
+            expires = None if peerid is None else time.monotonic() + self.expiry
+            replica = entry[0].get((host, port))
+            if replica is None or replica.location != location:
+                entry[0][(host, port)] = MLReplica(location, expires)
+            else:
+                replica.expires = expires
+            entry[1], entry[2] = 0, False
+            self.negative.pop(name, None)
+            self.cond.notify_all()
+
+    def __getitem__(self, name):
+        location = self.lookup(name)
+        if location is None:
+            raise KeyError(name)
+        return location
+
+    def __delitem__(self, name):
+        with self.cond:
+            del self.entries[name]
+
+    def __contains__(self, name):
+        with self.cond:
+            return self.__live(name, time.monotonic()) is not None
+
+    def __len__(self):
+        return len(self.items())
+
+    def __iter__(self):
+        return iter([name for name, _ in self.items()])
+
+    def get(self, name, default=None):
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            return default if entry is None else self.__preferred(entry)
+
+    def pop(self, name, *default):
+        """Removes the model, returning a location of it."""
+
+        with self.cond:
+            entry = self.__live(name, time.monotonic())
+            if entry is None:
+                if default:
+                    return default[0]
+                raise KeyError(name)
+            del self.entries[name]
+            return self.__preferred(entry)
+
+    def items(self):
+        now = time.monotonic()
+        with self.cond:
+            return [(name, self.__preferred(entry))
+                    for name, entry in [(name, self.__live(name, now))
+                                        for name in list(self.entries)]
+                    if entry is not None]
+
+    def clear(self):
+        with self.cond:
+            self.entries.clear()
+            self.negative.clear()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class MLModelRegistry:
+    """
+    The models loaded on a peer, model name ==> model, kept within a memory
+    budget. Each model's footprint is estimated as the size of its pickle,
+    not counting the arrays of a mapped model (see save_mapped_model) that
+    are still views of the file, which live in the page cache. When the
+    models in memory add up to more than budget bytes, the least recently
+    used ones that were loaded from a file (see load) are evicted; they
+    still count as present and are loaded again from the same file the next
+    time they are used. Models added directly are never evicted. Evictions,
+    cold load times and the bytes in memory are recorded in metrics, if
+    given. If compile is set, the tree ensembles loaded from files are
+    compiled (see compile_model). dropped(model name), if set, is called
+    whenever a model is evicted or removed, so that copies of it kept
+    elsewhere (see MLProcessPool.drop) can be freed too.
+    """
+
+    def __init__(self, budget=None, metrics=None, compile=False, dropped=None):
+        self.budget = budget    # bytes, or None for no limit
+        self.metrics = metrics
+        self.compile = compile
+        self.dropped = dropped
+
+        self.lock = threading.Lock()
+        self.loaded = OrderedDict()     # name ==> model, least recently used first
+        self.footprints = {}            # name ==> estimated bytes, of loaded models
+        self.sources = {}               # name ==> path the model was loaded from
+        self.loadlocks = {}             # name ==> lock held while reloading it
+        self.versions = {}              # name ==> number changed by every load
+        self.nversions = 0
+        self.nbytes = 0
+
+    def __footprint(self, model):
+        try:
+            return len(pickle.dumps(model, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(model)
+
+    def __read(self, name, path):
+        """Loads the model at path, recording how long it took; returns it and its size."""
+
+        start = time.monotonic()
+        model, size = read_model(path, self.compile)
+        if self.metrics is not None:
+            self.metrics.observe('cold_load_seconds', name, time.monotonic() - start)
+        return model, size
+
+    def __store(self, name, model, footprint):
+        """Puts a model in memory and evicts others to get back within budget."""
+
+        evicted = []
+        with self.lock:
+            self.nbytes -= self.footprints.pop(name, 0)
+            self.loaded[name] = model
+            self.loaded.move_to_end(name)
+            self.footprints[name] = footprint
+            self.nbytes += footprint
+
+            if self.budget is not None:
+                for other in list(self.loaded):
+                    if self.nbytes <= self.budget:
+                        break
+                    if other != name and other in self.sources:
+                        del self.loaded[other]
+                        self.nbytes -= self.footprints.pop(other)
+                        evicted.append(other)
+            nbytes = self.nbytes
+
+        if self.metrics is not None:
+            for other in evicted:
+                self.metrics.count('model_evictions', other)
+            self.metrics.setgauge('models', 'bytes', nbytes)
+        if self.dropped is not None:
+            for other in evicted:
+                self.dropped(other)
+
+    def load(self, name, path):
+        """
+        load(model name, path of pickle or mapped model file) -> model
+
+        Loads a model from a file and remembers the path, so the
+        model can be evicted and loaded again when needed.
+        """
+
+        model, size = self.__read(name, path)
+        with self.lock:
+            self.sources[name] = path
+            self.nversions += 1
+            self.versions[name] = self.nversions
+        self.__store(name, model, size)
+        return model
+
+    def version(self, name):
+        """
+        Returns a number that changes whenever the model is loaded or
+        replaced (but not when it is just reloaded after eviction).
+        """
+
+        with self.lock:
+            return self.versions.get(name)
+
+    def source(self, name):
+        """Returns the path the model was loaded from, or None."""
+
+        with self.lock:
+            return self.sources.get(name)
+
+    def isloaded(self, name):
+        """Returns whether the model is in memory."""
+
+        with self.lock:
+            return name in self.loaded
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return self.loaded[name]
+            if name not in self.sources:
+                raise KeyError(name)
+            loadlock = self.loadlocks.setdefault(name, threading.Lock())
+
+        with loadlock:
+            with self.lock:
+                if name in self.loaded:     # reloaded while we waited
+                    self.loaded.move_to_end(name)
+                    return self.loaded[name]
+                path = self.sources.get(name)
+            if path is None:    # removed while we waited
+                raise KeyError(name)
+            model, size = self.__read(name, path)
+            self.__store(name, model, size)
+        return model
+
+    def __setitem__(self, name, model):
+        with self.lock:
+            self.sources.pop(name, None)
+            self.nversions += 1
+            self.versions[name] = self.nversions
+        self.__store(name, model, self.__footprint(model))
+
+    def __delitem__(self, name):
+        with self.lock:
+            if name not in self.loaded and name not in self.sources:
+                raise KeyError(name)
+            self.loaded.pop(name, None)
+            self.nbytes -= self.footprints.pop(name, 0)
+            self.sources.pop(name, None)
+            self.loadlocks.pop(name, None)
+            self.versions.pop(name, None)
+        if self.dropped is not None:
+            self.dropped(name)
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.loaded or name in self.sources
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.loaded) + [name for name in self.sources
+                                        if name not in self.loaded]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def pop(self, name, *default):
+        try:
+            model = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return model
+
+
+def processworker(conn):
+    """
+    Main loop of an MLProcessPool worker process. It receives commands over
+    conn: ('load', model name, path or None, pickled model or None,
+    compile it?) to load or replace a model, ('drop', model name) to free
+    it, ('predict', model name, input block name, dtype, shape) to run a
+    model on the array in that shared memory block, answered with ('ok',
+    output block name, dtype, shape) or ('error', message), and ('stop',). The output block is created and owned
+    by the worker and replaced by a larger one when needed. Workers are
+    spawned by the pool, so they share its resource tracker, which frees any
+    block left behind by a worker that died.
+    """
+
+    models = {}
+    inbuf = outbuf = None
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == 'stop':
+                break
+
+            if command[0] == 'load':
+                _, name, path, data, compile = command
+                try:
+                    if path is not None:
+                        models[name] = read_model(path, compile)[0]
+                    else:
+                        models[name] = pickle.loads(data)
+                except Exception as e:
+                    models[name] = e    # reported when the model is used
+                continue
+
+            if command[0] == 'drop':
+                models.pop(command[1], None)
+                continue
+
+            _, name, inname, dtype, shape = command
+            try:
+                if inbuf is None or inbuf.name != inname:
+                    if inbuf is not None:
+                        inbuf.close()
+                    inbuf = shared_memory.SharedMemory(inname)
+                model = models[name]
+                if isinstance(model, Exception):
+                    raise model
+                X = np.ndarray(shape, dtype, buffer=inbuf.buf)
+                Y = np.asarray(model.predict(X))
+                del X
+                if Y.dtype.hasobject:
+                    Y = Y.astype(str)
+
+                if outbuf is None or outbuf.size < Y.nbytes:
+                    if outbuf is not None:
+                        outbuf.close()
+                        outbuf.unlink()
+                    outbuf = shared_memory.SharedMemory(
+                        create=True, size=max(Y.nbytes, 2 * (outbuf.size if outbuf else 0), 4096))
+                np.ndarray(Y.shape, Y.dtype, buffer=outbuf.buf)[...] = Y
+                conn.send(('ok', outbuf.name, Y.dtype.str, Y.shape))
+            except Exception as e:
+                conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if inbuf is not None:
+            inbuf.close()
+        if outbuf is not None:
+            outbuf.close()
+            outbuf.unlink()
+
+
+class MLProcessPool:
+    """
+    Runs the models of a MLModelRegistry in worker processes, which load
+    each model the first time they are asked to run it (from the file it was
+    loaded from, so that they all share a mapped model's arrays, or else
+    from a pickle of it). Input and output arrays are passed through shared
+    memory blocks kept for each worker, and only short commands go through
+    its pipe. A model may be pinned to some of the workers, so that the
+    others never load it, and dropped from them all when it is evicted or
+    removed from the registry.
+    """
+
+    def __init__(self, models, processes=None, metrics=None):
+        self.models = models
+        self.metrics = metrics
+        self.context = multiprocessing.get_context('spawn')
+
+        self.cond = threading.Condition()
+        self.workers = [self.__start() for _ in range(processes or os.cpu_count() or 1)]
+        self.idle = set(range(len(self.workers)))
+        self.pins = {}  # model name ==> indices of the workers that may run it
+
+    def __start(self):
+        conn, childconn = self.context.Pipe()
+        process = self.context.Process(target=processworker, args=(childconn,),
+                                       daemon=True)
+        process.start()
+        childconn.close()
+        # the worker's connection, process, models loaded (name ==> version),
+        # models to drop once it is idle, input block (owned here) and
+        # output block (owned by the worker)
+        return {'conn': conn, 'process': process, 'loaded': {}, 'drops': set(),
+                'inbuf': None, 'outbuf': None}
+
+    def pin(self, name, workers):
+        """Runs the model only on the workers with the given indices (None to lift the pin)."""
+
+        with self.cond:
+            if workers is None:
+                self.pins.pop(name, None)
+            else:
+                self.pins[name] = set(workers)
+
+    def drop(self, name):
+        """
+        Makes the workers that loaded the model free it: the idle ones at
+        once, the others as soon as they finish what they are running.
+        """
+
+        idle = []
+        with self.cond:
+            for i, worker in enumerate(self.workers):
+                if worker['loaded'].pop(name, None) is not None:
+                    worker['drops'].add(name)
+                    if i in self.idle:
+                        self.idle.discard(i)
+                        idle.append(i)
+        for i in idle:
+            self.__release(i)
+
+    def __acquire(self, name, version):
+        """Waits for an idle worker that may run the model, preferring one that has loaded it."""
+
+        with self.cond:
+            while True:
+                candidates = self.idle & self.pins.get(name, self.idle)
+                if candidates:
+                    loaded = [i for i in candidates
+                              if self.workers[i]['loaded'].get(name) == version]
+                    i = loaded[0] if loaded else min(candidates)
+                    self.idle.discard(i)
+                    return i
+                self.cond.wait()
+
+    def __release(self, i):
+        with self.cond:
+            if i >= len(self.workers):  # shut down meanwhile
+                return
+            worker = self.workers[i]
+            # a model loaded again since it was dropped stays
+            drops = worker['drops'] - set(worker['loaded'])
+            worker['drops'] = set()
+        try:
+            for name in drops:
+                worker['conn'].send(('drop', name))
+        except OSError:
+            self.__discard(i)
+        with self.cond:
+            self.idle.add(i)
+            self.cond.notify_all()
+
+    def __discard(self, i):
+        """Replaces a worker that failed with a fresh one."""
+
+        worker = self.workers[i]
+        worker['conn'].close()
+        worker['process'].kill()
+        for buf in (worker['inbuf'], worker['outbuf']):
+            if buf is not None:
+                buf.close()
+                try:
+                    buf.unlink()
+                except FileNotFoundError:
+                    pass
+        self.workers[i] = self.__start()
+
+    def predict(self, name, X):
+        """
+        predict(model name, input rows) -> predictions
+
+        Runs the model on X in one of the workers.
+        """
+
+        X = np.ascontiguousarray(X)
+        if X.dtype.hasobject:
+            raise ValueError('input must be a numeric array')
+        version = self.models.version(name)
+        if name not in self.models:
+            raise KeyError(name)
+
+        i = self.__acquire(name, version)
+        worker = self.workers[i]
+        try:
+            conn = worker['conn']
+            if worker['loaded'].get(name) != version:
+                path = self.models.source(name)
+                data = None if path else pickle.dumps(self.models[name],
+                                                      pickle.HIGHEST_PROTOCOL)
+                conn.send(('load', name, path, data, self.models.compile))
+                worker['loaded'][name] = version
+                if self.metrics is not None:
+                    self.metrics.count('process_loads', name)
+
+            inbuf = worker['inbuf']
+            if inbuf is None or inbuf.size < X.nbytes:
+                if inbuf is not None:
+                    inbuf.close()
+                    inbuf.unlink()
+                inbuf = worker['inbuf'] = shared_memory.SharedMemory(
+                    create=True, size=max(X.nbytes, 2 * (inbuf.size if inbuf else 0), 4096))
+            np.ndarray(X.shape, X.dtype, buffer=inbuf.buf)[...] = X
+
+            conn.send(('predict', name, inbuf.name, X.dtype.str, X.shape))
+            reply = conn.recv()
+            if reply[0] == 'error':
+                raise RuntimeError('worker %d: %s' % (i, reply[1]))
+
+            _, outname, dtype, shape = reply
+            outbuf = worker['outbuf']
+            if outbuf is None or outbuf.name != outname:
+                if outbuf is not None:
+                    outbuf.close()
+                outbuf = worker['outbuf'] = shared_memory.SharedMemory(outname)
+            Y = np.ndarray(shape, dtype, buffer=outbuf.buf).copy()
+        except (EOFError, OSError):
+            self.__discard(i)
+            raise
+        finally:
+            self.__release(i)
+        return Y
+
+    def shutdown(self):
+        """Stops the workers and frees the shared memory."""
+
+        with self.cond:
+            workers, self.workers, self.idle = self.workers, [], set()
+        for worker in workers:
+            try:
+                worker['conn'].send(('stop',))
+            except OSError:
+                pass
+            worker['process'].join(1)
+            if worker['process'].is_alive():
+                worker['process'].kill()
+            worker['conn'].close()
+            for buf in (worker['inbuf'], worker['outbuf']):
+                if buf is not None:
+                    buf.close()
+            if worker['inbuf'] is not None:
+                worker['inbuf'].unlink()
+
+
+class MLLoadJob:
+    """
+    A model being fetched and loaded by an MLModelLoader. Its state goes
+    from 'queued' to 'fetching' (with nbytes of total bytes downloaded,
+    where the size is known), then 'loading', then 'done' or 'failed'
+    (with the error).
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, name, source):
+        self.id = next(MLLoadJob.ids)
+        self.name = name
+        self.source = source
+        self.state = 'queued'
+        self.nbytes = 0
+        self.total = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.cached = False     # whether it came from the artifact cache
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def advance(self, nbytes):
+        with self.lock:
+            self.nbytes += nbytes
+
+    def finish(self, error=None):
+        self.error = error
+        self.state = 'failed' if error is not None else 'done'
+        self.finished = time.time()
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish; returns whether it loaded the model."""
+
+        self.event.wait(timeout)
+        return self.state == 'done'
+
+    def status(self):
+        return {'id': self.id, 'model': self.name, 'source': self.source,
+                'state': self.state, 'bytes': self.nbytes, 'total': self.total,
+                'cached': self.cached, 'error': None if self.error is None else str(self.error),
+                'seconds': round((self.finished or time.time()) - self.submitted, 3)}
+
+    def __repr__(self):
+        progress = '%d bytes' % self.nbytes
+        if self.total:
+            progress = '%d/%d bytes (%d%%)' % (self.nbytes, self.total,
+                                              100 * self.nbytes // self.total)
+        if self.cached:
+            progress = 'from the cache'
+        text = 'load #%d %s from %s: %s, %s' % (self.id, self.name, self.source,
+                                                self.state, progress)
+        if self.error is not None:
+            text += ': %s' % self.error
+        return text
+
+
+class MLModelLoader:
+    """
+    Fetches and loads models, one job (MLLoadJob) per model, either in the
+    calling thread or in the background, at most maxjobs at a time. A job
+    fetches the model with the function it is submitted with, which
+    returns the path of the model file, and then loads it with load(model
+    name, path). Downloads from S3 are split into ranges of chunksize
+    bytes fetched maxstreams at a time (by all jobs together). The cloud
+    clients are made by aws_session and azure_client, which can be
+    replaced, e.g. by local stand-ins.
+    """
+
+    def __init__(self, load, metrics=None, maxjobs=4, maxstreams=8,
+                 chunksize=8 << 20, maxhistory=100):
+        self.load = load
+        self.metrics = metrics
+        self.chunksize = chunksize
+        self.retries = 2        # times each range is tried again
+        self.maxhistory = maxhistory
+
+        self.aws_session = boto3.session.Session
+        self.azure_client = lambda tenant_id, subscription_id, resource_group, workspace_name: \
+            MLClient(InteractiveBrowserCredential(tenant_id=tenant_id),
+                     subscription_id, resource_group, workspace_name)
+
+        self.jobs = ThreadPoolExecutor(max_workers=maxjobs,
+                                       thread_name_prefix='btload')
+        self.streams = ThreadPoolExecutor(max_workers=maxstreams,
+                                          thread_name_prefix='btdownload')
+        self.lock = threading.Lock()
+        self.history = OrderedDict()    # job id ==> job, oldest first
+
+        # MLArtifactCache of downloaded models, if enabled
+        self.cache = None
+
+    def submit(self, name, source, fetch, background=True):
+        """
+        submit(model name, source description, fetch function, run in
+        the background?) -> MLLoadJob
+        """
+
+        job = MLLoadJob(name, source)
+        with self.lock:
+            self.history[job.id] = job
+            while len(self.history) > self.maxhistory:
+                oldest = next(iter(self.history.values()))
+                if oldest.finished is None:
+                    break
+                self.history.popitem(last=False)
+
+        if background:
+            self.jobs.submit(self.__run, job, fetch)
+        else:
+            self.__run(job, fetch)
+        return job
+
+    def __run(self, job, fetch):
+        start = time.monotonic()
+        try:
+            job.state = 'fetching'
+            path = fetch(job)
+            job.state = 'loading'
+            self.load(job.name, path)
+        except Exception as e:
+            job.finish(e)
+            if self.metrics is not None:
+                self.metrics.count('model_load_failures', job.source)
+            return
+
+        job.finish()
+        if self.metrics is not None:
+            self.metrics.count('model_loads', job.source)
+            self.metrics.observe('model_load_seconds', job.source,
+                                 time.monotonic() - start)
+
+    def status(self):
+        """Returns the status of the jobs not yet finished and of the last ones that did."""
+
+        with self.lock:
+            return [job.status() for job in self.history.values()]
+
+    def download_s3(self, job, s3, bucket, key, path, name=None):
+        """
+        Downloads an S3 object to path, in ranges fetched in parallel, or
+        copies it from the cache, if enabled and it is there, under the
+        model name, the object's version and its ETag.
+        """
+
+        head = s3.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength']
+
+        def openrange(start, end):
+            return s3.get_object(Bucket=bucket, Key=key,
+                                 Range='bytes=%d-%d' % (start, end - 1))['Body']
+
+        if self.cache is None:
+            self.download(job, size, openrange, path)
+            return
+
+        etag = head.get('ETag', '').strip('"')
+        cachekey = self.cache.key('s3', name or key, bucket, key,
+                                  head.get('VersionId', ''), etag)
+        cached = self.cache.lookup(cachekey)
+        if cached is None:
+            tmppath = self.cache.tmppath()
+            self.download(job, size, openrange, tmppath)
+            # the ETag of an object uploaded in one part is its MD5, unless
+            # it is encrypted with KMS or a customer key
+            encrypted = (head.get('ServerSideEncryption') == 'aws:kms' or
+                         'SSECustomerAlgorithm' in head)
+            md5 = etag if re.fullmatch('[0-9a-f]{32}', etag) and not encrypted else None
+            cached = self.cache.put(cachekey, tmppath, os.path.basename(path),
+                                    md5=md5, move=True)
+        else:
+            job.cached = True
+        self.cache.copyto(cached, path)
+
+    def download(self, job, size, openrange, path):
+        """
+        download(job, size, function opening a range, path) -> ()
+
+        Downloads size bytes to path, chunksize bytes at a time with up to
+        maxstreams ranges in flight. openrange(start, end) returns a
+        file-like object reading bytes start to end - 1. The file is
+        written in place, so that the ranges need not arrive in order,
+        and is only moved to path once complete.
+        """
+
+        job.total = size
+        tmppath = '%s.%s.part' % (path, uuid.uuid4().hex)
+        with open(tmppath, 'wb') as f:
+            f.truncate(size)
+
+        def fetch(start, end):
+            for attempt in range(self.retries + 1):
+                done = 0
+                try:
+                    body = openrange(start, end)
+                    with open(tmppath, 'r+b') as f:
+                        f.seek(start)
+                        while done < end - start:
+                            data = body.read(min(1 << 20, end - start - done))
+                            if not data:
+                                raise IOError('range %d-%d ended early' % (start, end))
+                            f.write(data)
+                            done += len(data)
+                            job.advance(len(data))
+                    return
+                except Exception:
+                    job.advance(-done)
+                    if attempt == self.retries:
+                        raise
+
+        ranges = []
+        try:
+            for start in range(0, size, self.chunksize):
+                ranges.append(self.streams.submit(
+                    fetch, start, min(start + self.chunksize, size)))
+            for future in ranges:
+                future.result()
+            os.replace(tmppath, path)
+        except BaseException:
+            for future in ranges:
+                future.cancel()
+            for future in ranges:
+                if not future.cancelled():
+                    future.exception()  # wait for the ranges in flight
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+        if self.metrics is not None:
+            self.metrics.count('download_bytes', job.source, size)
+
+    def shutdown(self):
+        self.jobs.shutdown(wait=False, cancel_futures=True)
+        self.streams.shutdown(wait=False, cancel_futures=True)
+
+
+class MLArtifactCache:
+    """
+    Downloaded model files kept under root, each stored once under the
+    SHA-256 digest of its contents however many keys (e.g. provider,
+    model name, version and ETag) refer to it, and checked against that
+    digest whenever it is used. The index of keys is kept in index.json,
+    so the cache outlives the peer. When the files add up to more than
+    maxbytes, the least recently used ones are removed. Hits, misses and
+    evictions are counted per provider (the first part of the key) in
+    metrics, if given.
+    """
+
+    def __init__(self, root, maxbytes=None, metrics=None):
+        self.root = root
+        self.maxbytes = maxbytes
+        self.metrics = metrics
+        self.lock = threading.RLock()
+
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        for file in os.listdir(os.path.join(root, 'tmp')):   # left by a crash
+            os.remove(os.path.join(root, 'tmp', file))
+
+        # key ==> {'digest', 'size', 'filename', 'used' (time.time())}
+        self.index = {}
+        try:
+            with open(os.path.join(root, 'index.json')) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.index = {key: entry for key, entry in self.index.items()
+                      if os.path.exists(self.objectpath(entry['digest']))}
+
+    @staticmethod
+    def key(*parts):
+        """key(parts...) -> key made of the parts"""
+
+        return '/'.join(urllib.parse.quote(str(part), safe='') for part in parts)
+
+    def objectpath(self, digest):
+        return os.path.join(self.root, 'objects', digest)
+
+    def tmppath(self):
+        """Returns a new path to download a file to before putting it in the cache."""
+
+        return os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+
+    def __digest(self, path):
+        sha256, md5 = hashlib.sha256(), hashlib.md5()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(data)
+                md5.update(data)
+        return sha256.hexdigest(), md5.hexdigest()
+
+    def __count(self, name, key):
+        if self.metrics is not None:
+            self.metrics.count(name, urllib.parse.unquote(key.split('/', 1)[0]))
+
+    def __save(self):
+        tmppath = self.tmppath()
+        with open(tmppath, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmppath, os.path.join(self.root, 'index.json'))
+
+    def lookup(self, key):
+        """
+        lookup(key) -> path of the cached file, or None
+
+        Returns None as well if the file no longer matches its digest, and
+        then forgets it.
+        """
+
+        with self.lock:
+            entry = self.index.get(key)
+        if entry is not None:
+            path = self.objectpath(entry['digest'])
+            try:
+                intact = self.__digest(path)[0] == entry['digest']
+            except OSError:
+                intact = False
+            with self.lock:
+                if intact:
+                    entry['used'] = time.time()
+                    self.__save()
+                    self.__count('artifact_cache_hits', key)
+                    return path
+                self.__remove(entry['digest'])
+                self.__save()
+        self.__count('artifact_cache_misses', key)
+        return None
+
+    def filename(self, key):
+        """Returns the name of the file put in the cache under key."""
+
+        with self.lock:
+            return self.index[key]['filename']
+
+    def put(self, key, path, filename=None, md5=None, move=False):
+        """
+        put(key, path of file, its name, its expected MD5, move it?) -> path of the cached file
+
+        Adds a file to the cache, moving it there if move is set and
+        otherwise linking or copying it. Raises ValueError, leaving the
+        cache as it was, if md5 is given and the file does not match it.
+        """
+
+        filename = filename or os.path.basename(path)
+        if not move:
+            tmppath = self.tmppath()
+            self.copyto(path, tmppath)
+            path = tmppath
+        try:
+            digest, actualmd5 = self.__digest(path)
+            if md5 is not None and actualmd5 != md5.lower():
+                raise ValueError('%s does not match MD5 %s' % (key, md5))
+        except BaseException:
+            os.remove(path)
+            raise
+
+        size = os.path.getsize(path)
+        with self.lock:
+            if os.path.exists(self.objectpath(digest)):
+                os.remove(path)     # the same file is already cached
+            else:
+                os.replace(path, self.objectpath(digest))
+            self.index[key] = {'digest': digest, 'size': size,
+                               'filename': filename,
+                               'used': time.time()}
+            self.__evict(digest)
+            self.__save()
+            if self.metrics is not None:
+                self.metrics.setgauge('artifact_cache', 'bytes', self.nbytes)
+        return self.objectpath(digest)
+
+    @property
+    def nbytes(self):
+        with self.lock:
+            return sum(dict((entry['digest'], entry['size'])
+                            for entry in self.index.values()).values())
+
+    def __remove(self, digest):
+        """Removes a file and every key referring to it."""
+
+        for key in [key for key, entry in self.index.items() if entry['digest'] == digest]:
+            del self.index[key]
+        try:
+            os.remove(self.objectpath(digest))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self, keep):
+        """Removes the least recently used files, except keep, while over maxbytes."""
+
+        if self.maxbytes is None:
+            return
+        used, sizes = {}, {}
+        for key, entry in self.index.items():
+            used[entry['digest']] = max(used.get(entry['digest'], 0), entry['used'])
+            sizes[entry['digest']] = entry['size']
+        nbytes = sum(sizes.values())
+        for digest in sorted(used, key=used.get):
+            if nbytes <= self.maxbytes:
+                break
+            if digest != keep:
+                key = next(key for key, entry in self.index.items()
+                           if entry['digest'] == digest)
+                self.__remove(digest)
+                nbytes -= sizes[digest]
+                self.__count('artifact_cache_evictions', key)
+
+    @staticmethod
+    def copyto(path, destination):
+        """Puts a copy of a file at destination, as a hard link if possible."""
+
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        tmppath = '%s.%s.tmp' % (destination, uuid.uuid4().hex)
+        try:
+            os.link(path, tmppath)
+        except OSError:
+            shutil.copyfile(path, tmppath)
+        os.replace(tmppath, destination)
+
+
+class MLResultCache:
+    """
+    Remembers predictions row by row, keyed by model name, model version
+    (see MLModelRegistry.version, so a reloaded model never sees its
+    predecessor's results) and a digest of the input row as
+    float64, so that [1, 2] and [1.0, 2.0] are the same row. A batch in
+    which some rows were seen before only has the others predicted. The
+    least recently used rows are evicted to stay within maxrows rows and
+    roughly maxbytes bytes. Hits, misses and evictions are counted per
+    model in metrics, if given.
+    """
+
+    ROWOVERHEAD = 200   # rough bytes per entry besides the prediction itself
+
+    def __init__(self, maxrows=100000, maxbytes=64 << 20, metrics=None):
+        self.maxrows = maxrows
+        self.maxbytes = maxbytes
+        self.metrics = metrics
+
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()   # (name, version, digest) ==> prediction, oldest first
+        self.nbytes = 0
+
+    def __count(self, event, name, n):
+        if self.metrics is not None and n:
+            self.metrics.count(event, name, n)
+
+    def __size(self, y):
+        return self.ROWOVERHEAD + y.nbytes
+
+    def predict(self, name, version, X, predict):
+        """
+        predict(model name, model version, input rows, predict function) -> predictions
+
+        Returns predict(X), calling predict only on the rows of X that are
+        not cached. Input that is not a 2-d numeric array is passed
+        straight through.
+        """
+
+        try:
+            rows = np.ascontiguousarray(X, np.float64)
+        except (TypeError, ValueError):
+            return predict(X)
+        if rows.ndim != 2:
+            return predict(X)
+
+        keys = [(name, version, hashlib.blake2b(row.tobytes(), digest_size=16).digest())
+                for row in rows]
+        Y = [None] * len(keys)
+        with self.lock:
+            for i, key in enumerate(keys):
+                y = self.rows.get(key)
+                if y is not None:
+                    self.rows.move_to_end(key)
+                    Y[i] = y
+        misses = [i for i, y in enumerate(Y) if y is None]
+        self.__count('result_cache_hits', name, len(keys) - len(misses))
+        self.__count('result_cache_misses', name, len(misses))
+
+        if misses:
+            Y_miss = np.asarray(predict(rows[misses] if len(misses) < len(keys) else X))
+            evicted = 0
+            with self.lock:
+                for i, y in zip(misses, Y_miss):
+                    y = np.array(y)     # own copy, not a view of Y_miss
+                    Y[i] = y
+                    if keys[i] not in self.rows:
+                        self.rows[keys[i]] = y
+                        self.nbytes += self.__size(y)
+                while self.rows and (len(self.rows) > self.maxrows or
+                                     self.nbytes > self.maxbytes):
+                    _, y = self.rows.popitem(last=False)
+                    self.nbytes -= self.__size(y)
+                    evicted += 1
+            self.__count('result_cache_evictions', name, evicted)
+            if len(misses) == len(keys):
+                return Y_miss
+
+        return np.asarray(Y)
+
+    def invalidate(self, name):
+        """Forgets all predictions of the named model."""
+
+        with self.lock:
+            for key in [key for key in self.rows if key[0] == name]:
+                self.nbytes -= self.__size(self.rows.pop(key))
+
+
+class MLBatcher:
+    """
+    Runs concurrent predict calls for one model as a single call on all of
+    their rows. The first caller to arrive leads a batch: it waits up to
+    window seconds, or until maxbatch rows have been collected, for other
+    callers to join, stacks their inputs into one array, predicts, and
+    hands each caller the slice of the result for its rows. Batches form
+    one after the other while earlier ones are still being predicted.
+    """
+
+    def __init__(self, predict, window=0.005, maxbatch=256, metrics=None, name=None):
+        self.predictbatch = predict
+        self.window = window
+        self.maxbatch = maxbatch
+        self.metrics = metrics
+        self.name = name
+
+        self.cond = threading.Condition()
+        self.pending = []   # jobs of the batch being formed
+        self.rows = 0       # rows in self.pending
+        self.leading = False
+
+    def predict(self, X):
+        """
+        predict(input rows) -> predictions
+
+        Returns the model's predictions for X, as if it had been passed to
+        the model's predict method on its own.
+        """
+
+        job = {'X': np.asarray(X), 'done': False}
+        with self.cond:
+            self.pending.append(job)
+            self.rows += len(job['X'])
+            if self.leading:
+                if self.rows >= self.maxbatch:
+                    self.cond.notify_all()
+                while not job['done']:
+                    self.cond.wait()
+            else:
+                self.leading = True
+                deadline = time.monotonic() + self.window
+                while self.rows < self.maxbatch:
+                    timeleft = deadline - time.monotonic()
+                    if timeleft <= 0:
+                        break
+                    self.cond.wait(timeleft)
+                batch, self.pending, self.rows = self.pending, [], 0
+                self.leading = False
+
+        if not job['done']:
+            self.__run(batch)
+            with self.cond:
+                self.cond.notify_all()
+
+        if 'error' in job:
+            raise job['error']
+        return job['Y']
+
+    def __run(self, batch):
+        try:
+            Y = self.predictbatch(np.concatenate([job['X'] for job in batch]))
+            offsets = np.cumsum([len(job['X']) for job in batch])[:-1]
+            for job, Y_job in zip(batch, np.split(Y, offsets)):
+                job['Y'] = Y_job
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0]['error'] = e
+            else:
+                # e.g. inputs of different widths: predict each on its own
+                # so that one bad request does not fail the others
+                for job in batch:
+                    try:
+                        job['Y'] = self.predictbatch(job['X'])
+                    except Exception as e:
+                        job['error'] = e
+
+        if self.metrics is not None:
+            self.metrics.count('batches', self.name)
+            self.metrics.count('batched_requests', self.name, len(batch))
+        for job in batch:
+            job['done'] = True
+
+
+class MLCompiledTrees:
+    """
+    A tree ensemble flattened into arrays of nodes (feature, threshold,
+    left and right child, leaf value), one array for all the trees, with
+    each leaf pointing back at itself. predict walks every input row down
+    every tree at once, one level per step, with a few NumPy operations
+    per level instead of the native per-tree calls, which dominate the
+    cost of small batches. It reproduces the native predict exactly,
+    including the order in which the trees' outputs are summed, and calls
+    it instead for input it does not handle and for batches of more than
+    maxrows rows, on which the native predict is faster (see
+    btml_bench.py). See compile_model for the models supported.
+    """
+
+    # missing value handling of LightGBM splits
+    MISSINGNONE, MISSINGZERO, MISSINGNAN = 0, 1, 2
+    ZEROTHRESHOLD = float(np.float32(1e-35))
+
+    # most (rows x trees) nodes walked at once
+    MAXWALK = 1 << 20
+
+    def __init__(self, model, kind, nfeatures):
+        self.model = model          # the native model
+        self.kind = kind            # e.g. 'forestclassifier', 'lgbclassifier'
+        self.nfeatures = nfeatures
+        self.dtype = np.float64     # the input is cast to this first
+        self.output = 'identity'    # or 'sigmoid' or 'softmax', for LightGBM
+        self.sigmoid = 1.0
+        self.nclasses = 1           # LightGBM scores per row
+        self.classes = getattr(model, 'classes_', None)
+        # larger batches go to the native predict
+        self.maxrows = 16 if kind.startswith('lgb') else 512
+
+        self.feature = []
+        self.threshold = []
+        self.left = []
+        self.right = []
+        self.values = []
+        self.missing = []
+        self.defaultleft = []
+        self.roots = []
+        self.treeclass = []
+        self.depth = 0
+
+    def addnode(self, feature=0, threshold=0.0, left=None, right=None,
+                value=None, missing=0, defaultleft=False):
+        """Adds a node (a leaf if left is None) and returns its index."""
+
+        i = len(self.feature)
+        self.feature.append(feature)
+        self.threshold.append(threshold)
+        self.left.append(i if left is None else left)
+        self.right.append(i if right is None else right)
+        self.values.append(value)
+        self.missing.append(missing)
+        self.defaultleft.append(defaultleft)
+        return i
+
+    def finish(self, valuewidth):
+        """Turns the lists of nodes into arrays."""
+
+        self.feature = np.asarray(self.feature, np.intp)
+        self.threshold = np.asarray(self.threshold, np.float64)
+        self.left = np.asarray(self.left, np.intp)
+        self.right = np.asarray(self.right, np.intp)
+        # both children of node i, at 2i and 2i + 1, so that a row goes to
+        # children[2i + (x > threshold)]
+        self.children = np.stack([self.left, self.right], axis=1).ravel()
+        values = np.zeros((len(self.values), valuewidth))
+        for i, value in enumerate(self.values):
+            if value is not None:
+                values[i] = value
+        self.values = values
+        self.missing = np.asarray(self.missing, np.uint8)
+        self.usesmissing = bool(self.missing.any())
+        self.haszeromissing = bool((self.missing == self.MISSINGZERO).any())
+        self.defaultleft = np.asarray(self.defaultleft, bool)
+        # where NaN and zero go: the default way at splits that treat them
+        # as missing, and otherwise as zero compares (NaN counts as zero)
+        zeroright = 0.0 > self.threshold
+        self.nanright = np.where(self.missing == self.MISSINGNONE,
+                                 zeroright, ~self.defaultleft)
+        self.zeroright = np.where(self.missing == self.MISSINGZERO,
+                                  ~self.defaultleft, zeroright)
+        self.roots = np.asarray(self.roots, np.intp)
+        self.treeclass = np.asarray(self.treeclass, np.intp)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.feature, self.threshold, self.left,
+                                      self.right, self.children, self.values,
+                                      self.missing, self.defaultleft,
+                                      self.nanright, self.zeroright))
+
+    def leaves(self, X):
+        """leaves(input rows as float64) -> the leaf each row reaches in each tree"""
+
+        n = len(X)
+        X = np.ascontiguousarray(X)
+        flat = X.ravel()
+        rowstart = np.arange(0, n * self.nfeatures, self.nfeatures)[:, None]
+        node = np.repeat(self.roots[None, :], n, axis=0)
+
+        hasnan = self.usesmissing and np.isnan(flat).any()
+        for _ in range(self.depth):
+            x = flat.take(rowstart + self.feature.take(node))
+            right = x > self.threshold.take(node)
+            if hasnan:
+                right |= np.isnan(x) & self.nanright.take(node)
+            if self.haszeromissing:
+                right = np.where(x == 0.0, self.zeroright.take(node), right)
+            node = self.children.take(2 * node + right)
+        return node
+
+    def predict(self, X):
+        """
+        predict(input rows) -> predictions
+
+        Returns what the native model's predict returns, computing it with
+        evaluate for batches of up to maxrows rows, and with the native
+        predict for larger ones, which it runs faster.
+        """
+
+        if len(X) > self.maxrows:
+            return self.model.predict(X)
+        return self.evaluate(X)
+
+    def evaluate(self, X):
+        """
+        evaluate(input rows) -> predictions
+
+        Computes what the native model's predict returns from the arrays
+        of nodes, unless X is not a plain numeric array of the right width
+        (or has missing values, which only LightGBM handles).
+        """
+
+        try:
+            A = np.asarray(X)
+            if A.ndim != 2 or A.shape[1] != self.nfeatures or \
+                    A.dtype.kind not in 'biuf':
+                return self.model.predict(X)
+            # float32 first, exactly as sklearn's trees compare
+            A = A.astype(self.dtype, copy=False).astype(np.float64, copy=False)
+            if self.kind.startswith('lgb'):
+                # LightGBM drops values this close to zero from its rows
+                A = np.where(np.abs(A) <= self.ZEROTHRESHOLD, 0.0, A)
+            elif np.isnan(A).any():
+                return self.model.predict(X)
+        except (TypeError, ValueError):
+            return self.model.predict(X)
+
+        step = max(1, self.MAXWALK // len(self.roots))
+        return np.concatenate([self.__evaluate(A[i:i + step])
+                               for i in range(0, len(A), step)]) \
+            if len(A) > step else self.__evaluate(A)
+
+    def __evaluate(self, X):
+        leaves = self.leaves(X)
+
+        if self.kind in ('treeclassifier', 'treeregressor'):
+            values = self.values.take(leaves[:, 0], axis=0)
+            if self.kind == 'treeregressor':
+                return values[:, 0]
+            return self.classes.take(np.argmax(values, axis=1), axis=0)
+
+        # the trees' outputs added up one after another, in the order the
+        # native predict adds them, so that the sums are exactly the same
+        if self.kind in ('forestclassifier', 'forestregressor'):
+            out = np.cumsum(self.values.take(leaves, axis=0), axis=1)[:, -1]
+            out /= len(self.roots)
+            if self.kind == 'forestregressor':
+                return out[:, 0]
+            return self.classes.take(np.argmax(out, axis=1), axis=0)
+
+        # LightGBM: tree t adds to the score of class t % nclasses
+        values = self.values[:, 0].take(leaves).reshape(len(X), -1, self.nclasses)
+        score = np.cumsum(values, axis=1)[:, -1]
+        if self.output == 'sigmoid':
+            result = 1.0 / (1.0 + self.__exp(-self.sigmoid * score[:, 0]))
+        elif self.output == 'softmax':
+            result = self.__exp(score - score.max(axis=1)[:, None])
+            result /= np.cumsum(result, axis=1)[:, -1:]
+        else:
+            result = score[:, 0]
+
+        if self.kind != 'lgbclassifier':
+            return result
+        if self.output == 'sigmoid':
+            result = np.vstack((1. - result, result)).transpose()
+        return self.classes.take(np.argmax(result, axis=1), axis=0)
+
+    def __exp(self, a):
+        # the C library's exp, as LightGBM uses, rather than NumPy's own,
+        # which may differ in the last bit
+        return np.fromiter(map(math.exp, a.ravel().tolist()), np.float64,
+                           a.size).reshape(a.shape)
+
+    def probe(self, nrows=512, seed=0):
+        """
+        Returns input rows made of the ensemble's thresholds and the
+        numbers just below and above them, so that they take both sides
+        of many splits, with some zeros and NaNs for the missing value
+        handling.
+        """
+
+        rng = np.random.default_rng(seed)
+        X = np.zeros((nrows, self.nfeatures))
+        internal = self.left != np.arange(len(self.left))
+        for j in range(self.nfeatures):
+            thresholds = self.threshold[internal & (self.feature == j)]
+            if len(thresholds):
+                with np.errstate(over='ignore'):
+                    candidates = np.concatenate([
+                        thresholds, np.nextafter(thresholds, -np.inf),
+                        np.nextafter(thresholds, np.inf),
+                        np.nextafter(thresholds.astype(np.float32), np.float32(np.inf))])
+                X[:, j] = rng.choice(candidates, nrows)
+        special = rng.random(X.shape)
+        X[special < 0.05] = 0.0
+        X[special > 0.95] = np.nan
+        return X
+
+    def validate(self, X=None):
+        """
+        Returns whether evaluate gives exactly what the native predict
+        gives, on X or else on rows made by probe (both with and without
+        missing values).
+        """
+
+        if X is None:
+            probes = self.probe()
+            return self.validate(np.nan_to_num(probes, nan=0.0)) and \
+                self.validate(probes)
+        try:
+            expected = self.model.predict(X)
+        except ValueError:  # e.g. NaNs a model does not accept
+            return True
+        actual = self.evaluate(X)
+        return np.shape(actual) == np.shape(expected) and \
+            np.array_equal(actual, expected)
+
+
+def compile_sklearn_trees(model):
+    """compile_sklearn_trees(model) -> MLCompiledTrees, or None if the model is not supported"""
+
+    if isinstance(model, (tree.DecisionTreeClassifier, tree.DecisionTreeRegressor)):
+        estimators = [model]
+        kind = 'tree'
+    elif isinstance(model, (ensemble.RandomForestClassifier, ensemble.RandomForestRegressor,
+                            ensemble.ExtraTreesClassifier, ensemble.ExtraTreesRegressor)):
+        estimators = model.estimators_
+        kind = 'forest'
+    else:
+        return None
+    if getattr(model, 'n_outputs_', 1) != 1 or not estimators:
+        return None
+    classifier = hasattr(model, 'classes_')
+    kind += 'classifier' if classifier else 'regressor'
+
+    compiled = MLCompiledTrees(model, kind, model.n_features_in_)
+    compiled.dtype = np.float32     # as sklearn's trees cast their input
+    for estimator in estimators:
+        t = estimator.tree_
+        values = t.value[:, 0, :]
+        if kind == 'forestclassifier':
+            # what each tree's predict_proba returns
+            normalizer = values.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            values = values / normalizer
+        base = len(compiled.feature)
+        compiled.roots.append(base)
+        for i in range(t.node_count):
+            if t.children_left[i] == -1:
+                compiled.addnode(value=values[i])
+            else:
+                compiled.addnode(int(t.feature[i]), float(t.threshold[i]),
+                                 base + int(t.children_left[i]),
+                                 base + int(t.children_right[i]))
+        compiled.depth = max(compiled.depth, t.max_depth)
+    compiled.finish(values.shape[1])
+    return compiled
+
+
+def compile_lightgbm(model):
+    """compile_lightgbm(model) -> MLCompiledTrees, or None if the model is not supported"""
+
+    if isinstance(model, Booster):
+        booster, kind = model, 'lgbbooster'
+    elif isinstance(model, (LGBMClassifier, LGBMRegressor)):
+        if callable(model.objective):
+            return None
+        booster = model.booster_
+        kind = 'lgbclassifier' if isinstance(model, LGBMClassifier) else 'lgbregressor'
+    else:
+        return None
+
+    dump = booster.dump_model()
+    objective = dump.get('objective', '').split()
+    compiled = MLCompiledTrees(model, kind, booster.num_feature())
+    compiled.nclasses = dump['num_tree_per_iteration']
+    if not objective:
+        return None
+    elif objective[0] == 'binary':
+        compiled.output = 'sigmoid'
+        for word in objective[1:]:
+            if word.startswith('sigmoid:'):
+                compiled.sigmoid = float(word.split(':', 1)[1])
+    elif objective[0] == 'multiclass':
+        compiled.output = 'softmax'
+    elif objective[0] not in ('regression', 'regression_l1', 'huber', 'fair',
+                              'quantile', 'mape', 'lambdarank', 'rank_xendcg') \
+            or 'sqrt' in objective:
+        return None
+    if kind == 'lgbclassifier' and compiled.output == 'identity':
+        return None
+
+    missingtypes = {'None': MLCompiledTrees.MISSINGNONE,
+                    'Zero': MLCompiledTrees.MISSINGZERO,
+                    'NaN': MLCompiledTrees.MISSINGNAN}
+    for index, info in enumerate(dump['tree_info']):
+        compiled.treeclass.append(index % compiled.nclasses)
+        # add the nodes depth first, filling in each split's children
+        # once they have been added
+        pending = [(info['tree_structure'], None, None, 1)]
+        while pending:
+            node, parent, side, depth = pending.pop()
+            if 'leaf_coeff' in node:    # linear trees
+                return None
+            if 'split_index' not in node:
+                i = compiled.addnode(value=[node['leaf_value']])
+            elif node['decision_type'] != '<=':     # categorical splits
+                return None
+            else:
+                # the dump writes infinite thresholds as +-1e300
+                threshold = float(node['threshold'])
+                if abs(threshold) >= 1e300:
+                    threshold = math.copysign(math.inf, threshold)
+                i = compiled.addnode(int(node['split_feature']), threshold,
+                                     missing=missingtypes[node['missing_type']],
+                                     defaultleft=bool(node['default_left']))
+                pending.append((node['right_child'], i, 'right', depth + 1))
+                pending.append((node['left_child'], i, 'left', depth + 1))
+            if parent is None:
+                compiled.roots.append(i)
+            else:
+                getattr(compiled, side)[parent] = i
+            compiled.depth = max(compiled.depth, depth - 1)
+    compiled.finish(1)
+    return compiled
+
+
+def compile_model(model):
+    """
+    compile_model(model) -> MLCompiledTrees, or None
+
+    Compiles a tree ensemble into an MLCompiledTrees, if it is one of
+    the supported models: single-output sklearn decision trees, random
+    forests and extra trees, and LightGBM boosters with numerical splits
+    and a regression, binary or multiclass objective (directly or through
+    LGBMRegressor or LGBMClassifier). Returns None for other models, and
+    for any compiled model that does not predict exactly as the native
+    one does on probing input (see MLCompiledTrees.validate).
+    """
+
+    if isinstance(model, MLCompiledTrees):
+        return model
+    try:
+        compiled = compile_sklearn_trees(model) or compile_lightgbm(model)
+        if compiled is not None and compiled.validate():
+            return compiled
+    except Exception:
+        pass    # keep the native model
+    return None
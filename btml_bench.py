@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Compares compiled tree ensembles (see compile_model) with the native
+predict of the same models: checks that both give exactly the same
+predictions, then times them on batches of different sizes.
+"""
+
+import sys
+import time
+
+from btml import *
+
+
+def make_models(nrows, nfeatures, ntrees):
+    rng = np.random.default_rng(0)
+    X = rng.random((nrows, nfeatures))
+    y = X[:, 0] + np.sin(3 * X[:, 1]) + 0.1 * rng.standard_normal(nrows)
+    labels = np.digitize(y, np.quantile(y, [0.33, 0.67]))
+    X[rng.random(X.shape) < 0.05] = np.nan   # for LightGBM only
+
+    Xdense = np.nan_to_num(X)
+    return X, {
+        'RandomForestClassifier': ensemble.RandomForestClassifier(ntrees, max_depth=12).fit(Xdense, labels),
+        'RandomForestRegressor': ensemble.RandomForestRegressor(ntrees, max_depth=12).fit(Xdense, y),
+        'ExtraTreesClassifier': ensemble.ExtraTreesClassifier(ntrees, max_depth=12).fit(Xdense, labels),
+        'LGBMClassifier (binary)': LGBMClassifier(n_estimators=ntrees, verbose=-1).fit(X, labels > 0),
+        'LGBMClassifier (multiclass)': LGBMClassifier(n_estimators=ntrees, verbose=-1).fit(X, labels),
+        'LGBMRegressor': LGBMRegressor(n_estimators=ntrees, verbose=-1).fit(X, y),
+    }
+
+
+def timeit(predict, X, mintime=0.2):
+    """Returns the mean seconds per call of predict(X), over at least mintime seconds."""
+
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        predict(X)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime:
+            return elapsed / calls
+
+
+def main(ntrees=100, batches=(1, 10, 100, 1000, 10000)):
+    X, models = make_models(20000, 20, ntrees)
+    rng = np.random.default_rng(1)
+
+    print('%-28s %7s %12s %12s %8s' % ('model', 'rows', 'native ms', 'compiled ms', 'speedup'))
+    for name, model in models.items():
+        start = time.perf_counter()
+        compiled = compile_model(model)
+        if compiled is None:
+            print('%-28s not supported' % name)
+            continue
+        compiletime = time.perf_counter() - start
+
+        test = X[rng.integers(0, len(X), max(batches))]
+        if name.startswith('LGBM'):
+            identical = compiled.validate(test)
+        else:
+            identical = compiled.validate(np.nan_to_num(test))
+        print('%-28s compiled in %.2f s, %d nodes, identical: %s' %
+              (name, compiletime, len(compiled.feature), identical))
+
+        for nrows in batches:
+            batch = test[:nrows] if name.startswith('LGBM') else np.nan_to_num(test[:nrows])
+            native = timeit(model.predict, batch)
+            fast = timeit(compiled.evaluate, batch)
+            print('%-28s %7d %12.3f %12.3f %7.1fx' %
+                  ('', nrows, native * 1000, fast * 1000, native / fast))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        print('Usage: %s [trees-per-model]' % sys.argv[0])
+        sys.exit(1)
+
+    main(*map(int, sys.argv[1:]))
@@ -167,9 +167,8 @@ class MLPeerGui(customtkinter.CTk):
         model_name = self.Azure_model_name_entry.get()
         model_version = self.Azure_model_version_entry.get() or None
 
-        self.mlpeer.load_model_from_Azure_ML(
-            tenant_id, subscription_id, resource_group, workspace_name, model_name, model_version, download_path)
-        self.update_models()
+        self.__watch_load(self.mlpeer.load_model_from_Azure_ML(
+            tenant_id, subscription_id, resource_group, workspace_name, model_name, model_version, download_path, True))
 
     def __on_press_AWS_fetch_and_load(self):
         download_path = tkinter.filedialog.asksaveasfilename(initialdir='.')
@@ -181,9 +180,8 @@ class MLPeerGui(customtkinter.CTk):
         region = self.AWS_region_entry.get()
         model_name = self.AWS_model_name_entry.get()
 
-        self.mlpeer.load_model_from_AWS_SageMaker(
-            access_key, secret_key, region, model_name, download_path)
-        self.update_models()
+        self.__watch_load(self.mlpeer.load_model_from_AWS_SageMaker(
+            access_key, secret_key, region, model_name, download_path, True))
 
     def __on_press_Local_load(self):
         path = tkinter.filedialog.askopenfilename(
@@ -194,7 +192,19 @@ class MLPeerGui(customtkinter.CTk):
         model_name = self.Local_model_name_entry.get()
         self.Local_model_name_entry.delete(0, len(model_name))
 
-        self.mlpeer.load_model_from_path(model_name, path)
+        self.__watch_load(
+            self.mlpeer.load_model_from_path(model_name, path, True))
+
+    def __watch_load(self, job, interval=500):
+        """Logs a background model load's progress until it finishes."""
+
+        if job.finished is None:
+            if job.state == 'fetching' and job.total:
+                self.log_textbox_print(job)
+            self.after(interval, self.__watch_load, job, interval)
+            return
+
+        self.log_textbox_print(job)
         self.update_models()
 
     def __on_press_start_monitoring(self):
@@ -251,9 +261,7 @@ class MLPeerGui(customtkinter.CTk):
                         self.log_textbox_print("Query model: invalid ttl")
                         return
 
-                    for peerid in self.mlpeer.getpeerids():
-                        self.mlpeer.sendtopeer(
-                            peerid, QUERY, "%s %s %d %s %d" % (self.mlpeer.myid, self.mlpeer.serverhost, self.mlpeer.serverport, model_name, ttl), self.mlpeer.debug)
+                    self.mlpeer.query_model(model_name, ttl)
             case "Connect and send":
                 connect_and_send_input = input.split(maxsplit=3)
                 if len(connect_and_send_input) == 4:
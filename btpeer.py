@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 
+import asyncio
+import bisect
+import collections
+import copy
+import itertools
+import json
+import os
+import queue
+import select
 import socket
 import struct
 import threading
 import time
 import traceback
+from types import MappingProxyType
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 # import requests
 
+# framework-level message types, handled by BTPeer itself
+KEEPALIVE = "KEEP"  # switch the connection to keep-alive mode
+DONE = "DONE"       # end of the replies to one keep-alive request
+MULTIPLEX = "MPLX"  # switch the connection to multiplexed framing
+STREAM = "STRM"     # start of a streamed message; data is its message type
+CHUNK = "CHNK"      # one chunk of a streamed message; empty at its end
+ERROR = "ERRO"      # request refused, e.g. because the peer is too busy
+
 
 def btdebug(msg):
     """Prints a messsage to the screen with the name of the current thread"""
@@ -44,12 +64,37 @@ class BTPeer:
         else:
             self.myid = "%s:%d" % (self.serverhost, self.serverport)
 
-        # ensure proper access to peers list (maybe better to use threading.RLock (reentrant))
-        self.peerlock = threading.Lock()
-        self.peers = {}  # peerid ==> (host, port) mapping
+        # peerid ==> (host, port) mapping; readers get a consistent snapshot
+        # without locking, peerlock serializes compound updates
+        self.peers = BTPeerTable()
+        self.peerlock = self.peers.lock
         self.shutdown = False  # used to stop the main loop
 
+        # outbound keep-alive connections (set to None to disable), and how
+        # long an inbound keep-alive connection may sit idle
+        self.connpool = BTPeerConnectionPool()
+        self.keepalivetimeout = 60.0
+        # seconds allowed for connecting to a peer, for any single read or
+        # write on a connection (in both directions), and for a whole
+        # connectandsend exchange; None means no limit
+        self.connecttimeout = 5.0
+        self.readtimeout = 30.0
+        self.requesttimeout = 60.0
+        # checklivepeers: per-probe deadline, attempts after the first
+        # before a peer is given up on, and number of concurrent probes
+        self.probetimeout = 2.0
+        self.proberetries = 1
+        self.probeworkers = 16
+        # send outbound requests over one multiplexed connection per peer
+        self.multiplex = False
+        # runs the handlers of blocking message types (set to None to run
+        # each in the thread that received its message)
+        self.workers = BTPeerWorkerPool()
+        self.metrics = BTPeerMetrics()
+
         self.handlers = {}
+        self.streamhandlers = {}
+        self.nonblocking = set()  # msgtypes whose handlers never block
         self.router = None
 
     def __initserverhost(self):
@@ -81,32 +126,200 @@ class BTPeer:
 
         host, port = clientsock.getpeername()
         self.__debug("Connected " + str((host, port)))
+        self.metrics.count("connections", "accepted")
+        self.metrics.adjust("connections", "active", 1)
 
         try:
             peerconn = BTPeerConnection(
                 None, host, port, clientsock, self.debug)
-            msgtype, msgdata = peerconn.recvdata()
-            if msgtype:
-                msgtype = msgtype.upper()
-            if msgtype not in self.handlers:
-                self.__debug("Not handled: %s: %s" % (msgtype, msgdata))
+            msgtype, chunks = peerconn.recvstream()
+            if msgtype == KEEPALIVE:
+                self.__keepalive(peerconn)
+            elif msgtype == MULTIPLEX:
+                self.__multiplex(peerconn)
             else:
-                self.__debug("Handling peer msg: %s: %s" % (msgtype, msgdata))
-                self.handlers[msgtype](peerconn, msgdata)
+                self.__dispatch(peerconn, msgtype, chunks, peerconn.streamed)
         except KeyboardInterrupt:
             raise
         except:
             if self.debug:
                 traceback.print_exc()
+        finally:
+            self.metrics.adjust("connections", "active", -1)
 
         self.__debug("Disconnecting " + str((host, port)))
         clientsock.close()
 
+    def __dispatch(self, peerconn, msgtype, chunks, streamed=False):
+        """
+        Calls the handler registered for msgtype, if there is one. chunks
+        iterates over the message data. A streamed message goes to the
+        stream handler for its type if there is one, otherwise it is joined
+        and decoded for the regular handler, and the other way around for a
+        plain message.
+        """
+
+        if msgtype:
+            msgtype = msgtype.upper()
+            chunks = self.__counted(msgtype, chunks)
+        if msgtype in self.streamhandlers and (streamed or msgtype not in self.handlers):
+            self.__debug("Handling peer stream: %s" % msgtype)
+            self.__run(peerconn, msgtype, self.streamhandlers[msgtype], chunks)
+        elif msgtype in self.handlers:
+            msgdata = self.__decode(chunks)
+            self.__debug("Handling peer msg: %s: %s" % (msgtype, msgdata))
+            if msgtype in self.nonblocking:
+                self.__call(peerconn, msgtype, self.handlers[msgtype], msgdata)
+            else:
+                self.__run(peerconn, msgtype, self.handlers[msgtype], msgdata)
+        else:
+            self.__debug("Not handled: %s" % msgtype)
+            if msgtype:
+                self.metrics.count("unhandled", msgtype)
+
+    def __counted(self, msgtype, chunks):
+        """Passes chunks through, adding up their size as bytes_in for msgtype."""
+
+        for chunk in chunks:
+            self.metrics.count("bytes_in", msgtype, len(chunk))
+            yield chunk
+
+    def __call(self, peerconn, msgtype, handler, arg, submitted=None):
+        """
+        Calls handler(peerconn, arg) and records how long it took, how long
+        it waited in the worker pool since submitted, what it sent back and
+        whether it raised.
+        """
+
+        start = time.monotonic()
+        if submitted is not None:
+            self.metrics.observe("queue_seconds", msgtype, start - submitted)
+        bytesout = peerconn.bytesout
+        try:
+            handler(peerconn, arg)
+        except:
+            self.metrics.count("errors", msgtype)
+            raise
+        finally:
+            self.metrics.count("messages", msgtype)
+            self.metrics.count("bytes_out", msgtype, peerconn.bytesout - bytesout)
+            self.metrics.observe("handle_seconds", msgtype,
+                                 time.monotonic() - start)
+
+    def __run(self, peerconn, msgtype, handler, arg):
+        """
+        Calls handler(peerconn, arg) in the worker pool, if there is one,
+        and waits for it to return. Replies busy if the queue for msgtype
+        is full.
+        """
+
+        if self.workers is None:
+            self.__call(peerconn, msgtype, handler, arg)
+            return
+
+        future = self.workers.submit(msgtype, self.__call, peerconn, msgtype,
+                                     handler, arg, time.monotonic())
+        if future is None:
+            self.__busy(peerconn, msgtype)
+        else:
+            future.result()
+
+    def __busy(self, peerconn, msgtype):
+        self.metrics.count("shed", msgtype)
+        retryafter = self.workers.retryafter(msgtype)
+        self.__debug("Busy, shedding %s (retry after %.1fs)" %
+                     (msgtype, retryafter))
+        peerconn.senddata(ERROR, "Busy: retry after %.1f" % retryafter)
+
+    def __decode(self, chunks):
+        chunks = list(chunks)
+        return str(chunks[0] if len(chunks) == 1 else b"".join(chunks), "utf-8")
+
+    def __drain(self, chunks):
+        """
+        Skips whatever part of a streamed message its handler left unread.
+        Returns False if the stream broke off.
+        """
+
+        try:
+            for _ in chunks:
+                pass
+        except EOFError:
+            return False
+        return True
+
+    def __keepalive(self, peerconn):
+        """
+        Serves a connection that opened with a KEEPALIVE message: every
+        following message is dispatched as usual and its replies are
+        terminated by a DONE message instead of by closing the socket. The
+        connection ends when the client closes it or stays idle for longer
+        than self.keepalivetimeout seconds.
+        """
+
+        peerconn.settimeout(self.keepalivetimeout)
+        peerconn.senddata(DONE, "")
+        while not self.shutdown:
+            msgtype, chunks = peerconn.recvstream()
+            if not msgtype:
+                break
+
+            try:
+                self.__dispatch(peerconn, msgtype, chunks, peerconn.streamed)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if self.debug:
+                    traceback.print_exc()
+
+            if not self.__drain(chunks) or not peerconn.senddata(DONE, ""):
+                break
+
+    def __multiplex(self, peerconn):
+        """
+        Serves a connection that opened with a MULTIPLEX message. From then
+        on every message carries a request id; requests are handled
+        concurrently and their replies, each terminated by DONE, are sent
+        back tagged with the id of the request they answer, in whatever
+        order they complete. The connection ends when the client closes it.
+        """
+
+        peerconn.senddata(DONE, "")
+        peerconn.settimeout(self.keepalivetimeout)
+        peerconn.writelock = threading.Lock()
+        while not self.shutdown:
+            msgtype, reqid, msgdata = peerconn.recvframebytes()
+            if not msgtype:
+                break
+
+            stream = peerconn.forrequest(reqid)
+            if msgtype.upper() in self.nonblocking:
+                self.__serverequest(stream, msgtype, msgdata)
+            else:
+                t = threading.Thread(target=self.__serverequest,
+                                     args=[stream, msgtype, msgdata])
+                t.start()
+
+    def __serverequest(self, stream, msgtype, msgdata):
+        try:
+            self.__dispatch(stream, msgtype, [msgdata])
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+
+        stream.senddata(DONE, "")
+
     def __runstabilizer(self, stabilizer, delay):
         while not self.shutdown:
             if self.debug:
                 self.__debug("Running stabilizer...")
-            stabilizer()
+            try:
+                stabilizer()
+            except:     # keep stabilizing, a failed round is retried
+                if self.debug:
+                    traceback.print_exc()
             time.sleep(delay)
 
     def setmyid(self, myid):
@@ -121,11 +334,34 @@ class BTPeer:
                              args=[stabilizer, delay], daemon=True)
         t.start()
 
-    def addhandler(self, msgtype, handler):
-        """Registers the handler for the given message type with this peer."""
+    def addhandler(self, msgtype, handler, blocking=True):
+        """
+        Registers the handler for the given message type with this peer.
+        Handlers registered with blocking=False must return quickly without
+        waiting on locks or the network; they run in the thread that
+        received the message (on the event loop, for mainloop_async) rather
+        than in the worker pool, so they never queue behind expensive work.
+        """
 
         assert len(msgtype) == 4
         self.handlers[msgtype] = handler
+        if blocking:
+            self.nonblocking.discard(msgtype)
+        else:
+            self.nonblocking.add(msgtype)
+
+    def addstreamhandler(self, msgtype, handler):
+        """
+        Registers a handler for streamed messages of the given type (see
+        BTPeerConnection.sendstream). It is called as handler(peerconn,
+        chunks), where chunks iterates over the message data as it
+        arrives, so the handler can start work before the whole message
+        has been received. A plain message of a type that has no regular
+        handler is passed to the stream handler as a single chunk.
+        """
+
+        assert len(msgtype) == 4
+        self.streamhandlers[msgtype] = handler
 
     def addrouter(self, router):
         """
@@ -145,22 +381,28 @@ class BTPeer:
     def addpeer(self, peerid, host, port):
         """Adds a peer name and host:port mapping to the known list of peers."""
 
-        if not self.maxpeersreached() and peerid != self.myid and peerid not in self.peers:
-            self.peers[peerid] = (host, int(port))
-            return True
-        else:
-            return False
+        with self.peerlock:
+            if not self.maxpeersreached() and peerid != self.myid and peerid not in self.peers:
+                self.peers.add(peerid, host, int(port))
+                return True
+            else:
+                return False
 
     def removepeer(self, peerid):
-        """Removes peer information from the known list of peers."""
+        """
+        Removes peer information from the known list of peers. Returns the
+        names the peer advertised (see BTPeerTable.advertise).
+        """
 
-        if peerid in self.peers:
-            del self.peers[peerid]
+        return self.peers.remove(peerid)
 
     def getpeerids(self):
-        """Returns a list of all known peer id's."""
+        """
+        Returns all known peer id's, as of now: the result is not affected
+        by peers being added or removed while it is iterated over.
+        """
 
-        return self.peers.keys()
+        return self.peers.snapshot.keys()
 
     def numberofpeers(self):
         """Returns the number of known peers."""
@@ -184,9 +426,9 @@ class BTPeer:
         s.listen(backlog)
         return s
 
-    def sendtopeer(self, peerid, msgtype, msgdata, waitreply=True):
+    def sendtopeer(self, peerid, msgtype, msgdata, waitreply=True, timeout=None):
         """
-        sendtopeer(peer id, message type, message data, wait for a reply) -> [(reply type, reply data), ...]
+        sendtopeer(peer id, message type, message data, wait for a reply, timeout) -> [(reply type, reply data), ...]
 
         Sends a message to the identified peer. In order to decide how to
         send the message, the router handler for this peer will be called.
@@ -204,34 +446,90 @@ class BTPeer:
             self.__debug("Unable to route %s to %s" %
                          (msgtype, peerid))
             return None
-        return self.connectandsend(host, port, msgtype, msgdata, peerid=nextpeerid, waitreply=waitreply)
+        return self.connectandsend(host, port, msgtype, msgdata, peerid=nextpeerid,
+                                   waitreply=waitreply, timeout=timeout)
 
-    def connectandsend(self, host, port, msgtype, msgdata, peerid=None, waitreply=True):
+    def connectandsend(self, host, port, msgtype, msgdata, peerid=None, waitreply=True, timeout=None, raw=False):
         """
-        connectandsend(host, port, message type, message data, peer id, wait for a reply) -> [(reply type, reply data), ...]
+        connectandsend(host, port, message type, message data, peer id, wait for a reply, timeout, raw) -> [(reply type, reply data), ...]
 
         Connects and sends a message to the specified host:port. The host's
-        reply, if expected, will be returned as a list of tuples.
+        reply, if expected, will be returned as a list of tuples. The whole
+        exchange must finish within timeout seconds (self.requesttimeout if
+        not given), or whatever was received by then is returned; connecting
+        and each read or write are further bounded by self.connecttimeout
+        and self.readtimeout. If raw is set, reply data is returned as
+        bytes-like objects instead of being decoded as UTF-8.
+        """
+
+        return self.__request(host, port, msgtype, msgdata, peerid, waitreply,
+                              timeout, raw, True)
+
+    def __request(self, host, port, msgtype, msgdata, peerid, waitreply, timeout, raw, block):
+        """
+        Sends a message as connectandsend does, counting it in the metrics.
+        Unless block is set, a peer whose pooled connections are all in use
+        is sent the message over a one-shot connection at once.
         """
 
+        start = time.monotonic()
+        msgreply = self.__connectandsend(host, port, msgtype, msgdata, peerid,
+                                         waitreply, timeout, raw, block)
+        self.metrics.count("requests", msgtype)
+        self.metrics.observe("request_seconds", msgtype,
+                             time.monotonic() - start)
+        return msgreply
+
+    def __connectandsend(self, host, port, msgtype, msgdata, peerid, waitreply, timeout, raw, block):
+        if timeout is None:
+            timeout = self.requesttimeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
         msgreply = []
         try:
-            peerconn = BTPeerConnection(peerid, host, port, None, self.debug)
+            if self.connpool and self.multiplex:
+                mux = self.connpool.getmux(
+                    peerid, host, port, self.__steptimeout(self.connecttimeout, deadline))
+                if mux:
+                    self.__debug("Sending %s (%s:%d) multiplexed: %s" %
+                                 (peerid, host, int(port), msgtype))
+                    msgreply = mux.request(msgtype, msgdata, waitreply,
+                                           self.__steptimeout(None, deadline), raw)
+                    if msgreply is not None:
+                        return msgreply
+                    msgreply = []
+
+            if self.connpool:
+                # waiting for a busy peer's pool leaves half the time left
+                # for falling back to a one-shot connection
+                halfway = None if deadline is None else \
+                    (time.monotonic() + deadline) / 2
+                peerconn = self.connpool.acquire(
+                    peerid, host, port, self.__steptimeout(self.connecttimeout, deadline),
+                    halfway, block)
+                if peerconn:
+                    return self.__sendkeepalive(peerconn, msgtype, msgdata, waitreply, deadline, raw)
+
+            peerconn = BTPeerConnection(peerid, host, port, None, self.debug,
+                                        self.__steptimeout(self.connecttimeout, deadline))
+            peerconn.settimeout(self.readtimeout, deadline)
             peerconn.senddata(msgtype, msgdata)
             self.__debug("Sent %s (%s:%d): %s" %
                          (peerid, host, int(port), msgtype))
 
             if waitreply:
-                onereply = peerconn.recvdata()
+                recv = peerconn.recvbytes if raw else peerconn.recvdata
+                onereply = recv()
                 while onereply != (None, None):
                     msgreply.append(onereply)
                     self.__debug("Got reply %s (%s:%d): %s" %
                                  (peerid, host, int(port), str(onereply)))
-                    onereply = peerconn.recvdata()
+                    onereply = recv()
             peerconn.close()
         except KeyboardInterrupt:
             raise
         except:
+            self.metrics.count("request_errors", msgtype)
             if self.debug:
                 self.__debug("%s:%d %s %s" %
                              (host, int(port), msgtype, msgdata))
@@ -239,28 +537,134 @@ class BTPeer:
 
         return msgreply
 
+    def __steptimeout(self, timeout, deadline):
+        """
+        Returns how long the next step may take: at most timeout seconds
+        and no later than deadline. Raises socket.timeout if the deadline
+        has passed.
+        """
+
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("deadline exceeded")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def connectandstream(self, host, port, msgtype, chunks, peerid=None):
+        """
+        connectandstream(host, port, message type, iterable of message data chunks, peer id) -> iterator of (reply type, iterator of reply data chunks)
+
+        Connects and streams a message to the specified host:port. The
+        chunks are sent from a background thread while the host's replies,
+        which may themselves be streamed, are yielded as they arrive; each
+        reply's chunks must be consumed before moving on to the next reply.
+        """
+
+        peerconn = BTPeerConnection(
+            peerid, host, port, None, self.debug, self.connecttimeout)
+        peerconn.settimeout(self.readtimeout)
+        try:
+            t = threading.Thread(target=peerconn.sendstream,
+                                 args=[msgtype, chunks], daemon=True)
+            t.start()
+            self.__debug("Streaming %s (%s:%d): %s" %
+                         (peerid, host, int(port), msgtype))
+
+            while True:
+                replytype, replychunks = peerconn.recvstream()
+                if replytype is None:
+                    break
+                self.__debug("Got reply %s (%s:%d): %s" %
+                             (peerid, host, int(port), replytype))
+                yield (replytype, replychunks)
+        finally:
+            peerconn.close()
+
+    def __sendkeepalive(self, peerconn, msgtype, msgdata, waitreply, deadline=None, raw=False):
+        """
+        Sends a message over a pooled keep-alive connection and reads its
+        replies up to the DONE marker, which are returned if waitreply is
+        set. A reused connection that turns out to be dead before anything
+        was received (and without timing out) is replaced once with a fresh
+        one.
+        """
+
+        host, port, peerid = peerconn.host, peerconn.port, peerconn.peerid
+        while True:
+            peerconn.settimeout(self.readtimeout, deadline)
+            msgreply = []
+            peerconn.senddata(msgtype, msgdata)
+            self.__debug("Sent %s (%s:%d): %s" %
+                         (peerid, host, port, msgtype))
+
+            recv = peerconn.recvbytes if raw else peerconn.recvdata
+            onereply = recv()
+            while onereply[0] not in (None, DONE):
+                msgreply.append(onereply)
+                self.__debug("Got reply %s (%s:%d): %s" %
+                             (peerid, host, port, str(onereply)))
+                onereply = recv()
+
+            if onereply[0] == DONE:
+                self.connpool.release(peerconn)
+                break
+
+            self.connpool.discard(peerconn)
+            if msgreply or not peerconn.reused or peerconn.timedout:
+                break
+            peerconn = self.connpool.acquire(
+                peerid, host, port, self.__steptimeout(self.connecttimeout, deadline),
+                deadline)
+            if not peerconn:
+                break
+
+        return msgreply if waitreply else []
+
     def checklivepeers(self):
         """
         Attempts to ping all currently known peers. Returns a list of those 
         that did not reply.
+
+        The peers are probed concurrently, at most self.probeworkers at a
+        time, without holding peerlock. A probe must be answered within
+        self.probetimeout seconds and a peer is only given up on after
+        self.proberetries further attempts. A probe never waits for a
+        connection to a busy peer, it uses a one-shot connection instead.
+        A round takes about one round-trip time for up to probeworkers
+        peers, and proportionally longer for more.
         """
 
-        todelete = []
-        self.peerlock.acquire()
-        for peerid in self.peers:
-            host, port = self.peers[peerid]
-            self.__debug("Check live %s (%s:%d)" % (peerid, host, port))
+        peers = list(self.peers.items())
+        if not peers:
+            return []
 
-            try:
-                if not self.connectandsend(host, port, "PING", "", peerid, True):
-                    todelete.append(peerid)
-            except:
-                todelete.append(peerid)
+        with ThreadPoolExecutor(max_workers=min(self.probeworkers, len(peers)),
+                                thread_name_prefix="btprobe") as executor:
+            alive = list(executor.map(self.__probe, peers))
 
-        self.peerlock.release()
+        todelete = []
+        for (peerid, (host, port)), isalive in zip(peers, alive):
+            if not isalive:
+                todelete.append(peerid)
+                if self.connpool:
+                    self.connpool.closepeer(host, port)
 
         return todelete
 
+    def __probe(self, peer):
+        peerid, (host, port) = peer
+        for attempt in range(1 + self.proberetries):
+            self.__debug("Check live %s (%s:%d), attempt %d" %
+                         (peerid, host, port, attempt + 1))
+            try:
+                if self.__request(host, port, "PING", "", peerid, True,
+                                  self.probetimeout, False, False):
+                    return True
+            except:
+                pass
+        return False
+
     def mainloop(self):
         s = self.makeserversocket(self.serverport)
         self.__debug("Server started: %s (%s:%d)" %
@@ -270,7 +674,7 @@ class BTPeer:
             try:
                 self.__debug("Listening for connections...")
                 clientsock, clientaddr = s.accept()
-                clientsock.settimeout(None)
+                clientsock.settimeout(self.readtimeout)
 
                 t = threading.Thread(
                     target=self.__handlepeer, args=[clientsock])
@@ -287,90 +691,1613 @@ class BTPeer:
         self.__debug("Main loop exiting")
 
         s.close()
+        if self.connpool:
+            self.connpool.closeall()
+        if self.workers:
+            self.workers.shutdown()
 
+    def mainloop_async(self, maxworkers=None):
+        """
+        mainloop_async(maximum executor threads) -> ()
+
+        Alternative to mainloop that serves the same wire protocol from a
+        single asyncio event loop instead of a thread per connection.
+        Handlers registered as non-blocking run on the loop itself; all
+        others are queued on self.workers (see BTPeerWorkerPool), which
+        answers with a busy error once a message type's queue is full. A
+        thread pool executor of at most maxworkers threads runs them instead
+        if self.workers is None, and drains the unread chunks of streamed
+        messages.
+        """
 
-# **********************************************************
+        try:
+            asyncio.run(self.__serveasync(maxworkers))
+        except KeyboardInterrupt:
+            print("KeyboardInterrupt: stopping mainloop")
+            self.shutdown = True
 
+        self.__debug("Main loop exiting")
+        if self.connpool:
+            self.connpool.closeall()
+        if self.workers:
+            self.workers.shutdown()
+
+    async def __serveasync(self, maxworkers):
+        s = self.makeserversocket(self.serverport, socket.SOMAXCONN)
+        self.__executor = ThreadPoolExecutor(max_workers=maxworkers,
+                                             thread_name_prefix="btpeer")
+        server = await asyncio.start_server(self.__handlepeerasync, sock=s)
+        self.__debug("Server started (async): %s (%s:%d)" %
+                     (self.myid, self.serverhost, self.serverport))
 
-class BTPeerConnection:
+        try:
+            async with server:
+                while not self.shutdown:
+                    await asyncio.sleep(0.5)
+        finally:
+            self.__executor.shutdown(wait=False)
 
-    def __init__(self, peerid, host, port, sock=None, debug=False):
-        # any exceptions thrown upwards
+    async def __handlepeerasync(self, reader, writer):
+        """
+        Coroutine counterpart of __handlepeer: dispatches the message read
+        from the stream to its handler, then closes the connection.
+        """
 
-        self.peerid = peerid
-        self.host = host
-        self.port = int(port)
-        self.debug = debug
+        host, port = writer.get_extra_info("peername")[:2]
+        self.__debug("Connected " + str((host, port)))
+        self.metrics.count("connections", "accepted")
+        self.metrics.adjust("connections", "active", 1)
 
-        if not sock:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.s.connect((self.host, self.port))
+        try:
+            peerconn = BTPeerAsyncConnection(
+                None, host, port, reader, writer, self.debug, self.readtimeout)
+            msgtype, chunks = await asyncio.wait_for(
+                peerconn.recvstreamasync(self.streamhandlers), self.readtimeout)
+            if msgtype == KEEPALIVE:
+                await self.__keepaliveasync(peerconn)
+            elif msgtype == MULTIPLEX:
+                await self.__multiplexasync(peerconn)
+            else:
+                await self.__dispatchasync(peerconn, msgtype, chunks, peerconn.streamed)
+            await asyncio.wait_for(writer.drain(), self.readtimeout)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+        finally:
+            self.metrics.adjust("connections", "active", -1)
+
+        self.__debug("Disconnecting " + str((host, port)))
+        writer.close()
+
+    async def __dispatchasync(self, peerconn, msgtype, chunks, streamed=False):
+        """
+        Coroutine counterpart of __dispatch. Stream handlers consume their
+        chunks with blocking reads, so they always run in the executor.
+        """
+
+        if msgtype:
+            msgtype = msgtype.upper()
+            chunks = self.__counted(msgtype, chunks)
+        if msgtype in self.streamhandlers and (streamed or msgtype not in self.handlers):
+            self.__debug("Handling peer stream: %s" % msgtype)
+            await self.__runasync(
+                peerconn, msgtype, self.streamhandlers[msgtype], chunks)
+            return
+        elif msgtype not in self.handlers:
+            self.__debug("Not handled: %s" % msgtype)
+            if msgtype:
+                self.metrics.count("unhandled", msgtype)
+            return
+
+        msgdata = self.__decode(chunks)
+        self.__debug("Handling peer msg: %s: %s" % (msgtype, msgdata))
+        if msgtype in self.nonblocking:
+            self.__call(peerconn, msgtype, self.handlers[msgtype], msgdata)
         else:
-            self.s = sock
+            await self.__runasync(
+                peerconn, msgtype, self.handlers[msgtype], msgdata)
+
+    async def __runasync(self, peerconn, msgtype, handler, arg):
+        """Coroutine counterpart of __run; uses the executor if there is no worker pool."""
+
+        if self.workers is None:
+            await asyncio.get_running_loop().run_in_executor(
+                self.__executor, self.__call, peerconn, msgtype, handler, arg,
+                time.monotonic())
+            return
+
+        future = self.workers.submit(msgtype, self.__call, peerconn, msgtype,
+                                     handler, arg, time.monotonic())
+        if future is None:
+            self.__busy(peerconn, msgtype)
+        else:
+            await asyncio.wrap_future(future)
 
-    def __makemsg(self, msgtype, msgdata):
-        msglen = len(msgdata)
+    async def __keepaliveasync(self, peerconn):
+        """Coroutine counterpart of __keepalive."""
 
-        msg = struct.pack("!4sL%ds" %
-                          msglen, msgtype.encode(), msglen, msgdata.encode())
-        return msg
+        loop = asyncio.get_running_loop()
+        peerconn.senddata(DONE, "")
+        while not self.shutdown:
+            try:
+                msgtype, chunks = await asyncio.wait_for(
+                    peerconn.recvstreamasync(self.streamhandlers),
+                    self.keepalivetimeout)
+            except asyncio.TimeoutError:
+                break
+            if not msgtype:
+                break
 
-    def __debug(self, msg):
-        if self.debug:
-            btdebug(msg)
+            streamed = peerconn.streamed
+            try:
+                await self.__dispatchasync(peerconn, msgtype, chunks, streamed)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if self.debug:
+                    traceback.print_exc()
 
-    def senddata(self, msgtype, msgdata):
-        """
-        senddata(message type, message data) -> boolean status
+            if streamed and not await loop.run_in_executor(
+                    self.__executor, self.__drain, chunks):
+                break
+            peerconn.senddata(DONE, "")
+            try:    # a peer that does not read its replies is dropped
+                await asyncio.wait_for(peerconn.writer.drain(), self.readtimeout)
+            except asyncio.TimeoutError:
+                break
 
-        Sends a message through a peer connection. Returns True on success
-        or False if there was an error.
-        """
+    async def __multiplexasync(self, peerconn):
+        """Coroutine counterpart of __multiplex."""
+
+        peerconn.senddata(DONE, "")
+        tasks = set()
+        while not self.shutdown:
+            try:
+                msgtype, reqid, msgdata = await asyncio.wait_for(
+                    peerconn.recvframebytesasync(), self.keepalivetimeout)
+            except asyncio.TimeoutError:
+                break
+            if not msgtype:
+                break
+
+            task = asyncio.ensure_future(self.__serverequestasync(
+                peerconn.forrequest(reqid), msgtype, msgdata))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
 
+    async def __serverequestasync(self, stream, msgtype, msgdata):
         try:
-            msg = self.__makemsg(msgtype, msgdata)
-            self.s.sendall(msg)
+            await self.__dispatchasync(stream, msgtype, [msgdata])
         except KeyboardInterrupt:
             raise
         except:
             if self.debug:
                 traceback.print_exc()
-            return False
-        return True
 
-    def recvdata(self):
+        stream.senddata(DONE, "")
+
+
+# **********************************************************
+
+
+class BTPeerTable:
+    """
+    The table of known peers, peer id ==> (host, port). Every update is
+    made under lock and publishes a new immutable snapshot, so readers
+    (routing, flooding, listing) never take the lock and can iterate
+    without the table changing under them. It also keeps a reverse index
+    from peer id to the names (e.g. models) that peer advertises; that
+    index may include peers that are not in the table.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.snapshot = MappingProxyType({})
+        self.advertised = {}    # peerid ==> frozenset of names
+
+    def add(self, peerid, host, port):
+        with self.lock:
+            peers = dict(self.snapshot)
+            peers[peerid] = (host, port)
+            self.snapshot = MappingProxyType(peers)
+
+    def remove(self, peerid):
+        """
+        Removes a peer, if present, and its advertised names. Returns the
+        names it advertised.
         """
-        recvdata() -> (msgtype, msgdata)
 
-        Receives a message from a peer connection. Returns (None, None)
-        if there was any error.
+        with self.lock:
+            if peerid in self.snapshot:
+                peers = dict(self.snapshot)
+                del peers[peerid]
+                self.snapshot = MappingProxyType(peers)
+
+            names = self.advertised.get(peerid, frozenset())
+            self.advertised = {p: n for p, n in self.advertised.items()
+                               if p != peerid}
+            return names
+
+    def advertise(self, peerid, name):
+        """Records that the peer advertises name."""
+
+        with self.lock:
+            advertised = dict(self.advertised)
+            advertised[peerid] = advertised.get(peerid, frozenset()) | {name}
+            self.advertised = advertised
+
+    def withdraw(self, peerid, name):
+        """Records that the peer no longer advertises name."""
+
+        with self.lock:
+            names = self.advertised.get(peerid, frozenset()) - {name}
+            advertised = dict(self.advertised)
+            if names:
+                advertised[peerid] = names
+            else:
+                advertised.pop(peerid, None)
+            self.advertised = advertised
+
+    def advertisedby(self, peerid):
+        """Returns the names the peer advertises."""
+
+        return self.advertised.get(peerid, frozenset())
+
+    def __setitem__(self, peerid, addr):
+        self.add(peerid, *addr)
+
+    def __delitem__(self, peerid):
+        self.remove(peerid)
+
+    def __getitem__(self, peerid):
+        return self.snapshot[peerid]
+
+    def __contains__(self, peerid):
+        return peerid in self.snapshot
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def get(self, peerid, default=None):
+        return self.snapshot.get(peerid, default)
+
+    def keys(self):
+        return self.snapshot.keys()
+
+    def items(self):
+        return self.snapshot.items()
+
+
+# **********************************************************
+
+
+class BTPeerMetrics:
+    """
+    Counters, gauges and latency histograms of a running peer, each kept
+    per name and key (a message type, a model name, ...). Recording is a
+    dictionary update under a lock, cheap enough to do on every message.
+    Histograms count observations in logarithmic buckets about 19% wide
+    from 10us to 10s, from which quantiles are estimated.
+    """
+
+    BOUNDS = tuple(1e-5 * 2 ** (i / 4) for i in range(81))
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}      # (name, key) ==> count
+        self.gauges = {}        # (name, key) ==> value
+        self.histograms = {}    # (name, key) ==> [bucket counts, count, sum, max]
+
+    def count(self, name, key, n=1):
+        with self.lock:
+            self.counters[(name, key)] = self.counters.get((name, key), 0) + n
+
+    def adjust(self, name, key, delta):
+        with self.lock:
+            self.gauges[(name, key)] = self.gauges.get((name, key), 0) + delta
+
+    def setgauge(self, name, key, value):
+        with self.lock:
+            self.gauges[(name, key)] = value
+
+    def observe(self, name, key, seconds):
+        i = bisect.bisect_left(self.BOUNDS, seconds)
+        with self.lock:
+            hist = self.histograms.get((name, key))
+            if hist is None:
+                hist = self.histograms[(name, key)] = [
+                    [0] * (len(self.BOUNDS) + 1), 0, 0.0, 0.0]
+            hist[0][i] += 1
+            hist[1] += 1
+            hist[2] += seconds
+            hist[3] = max(hist[3], seconds)
+
+    def __quantile(self, buckets, count, maximum, q):
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(self.BOUNDS[i], maximum) if i < len(self.BOUNDS) else maximum
+        return maximum
+
+    def snapshot(self):
         """
+        snapshot() -> dictionary
 
-        try:
-            msgtype = self.s.recv(4).decode()
-            if not msgtype:
-                return (None, None)
-            msglen = struct.unpack("!L", self.s.recv(4))[0]
-            msg = self.s.recv(msglen).decode()
-        except KeyboardInterrupt:
-            raise
-        except:
-            if self.debug:
-                traceback.print_exc()
-            return (None, None)
+        Returns the current values, as {"counters": {name: {key: count}},
+        "gauges": {name: {key: value}}, "histograms": {name: {key: {"count",
+        "sum", "max", "p50", "p90", "p99"}}}} plus the uptime in seconds.
+        """
 
-        return (msgtype, msg)
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: (list(h[0]), h[1], h[2], h[3])
+                          for k, h in self.histograms.items()}
+
+        stats = {"uptime": time.time() - self.started,
+                 "counters": {}, "gauges": {}, "histograms": {}}
+        for (name, key), value in counters.items():
+            stats["counters"].setdefault(name, {})[key] = value
+        for (name, key), value in gauges.items():
+            stats["gauges"].setdefault(name, {})[key] = value
+        for (name, key), (buckets, count, total, maximum) in histograms.items():
+            summary = {"count": count, "sum": total, "max": maximum}
+            for q in self.QUANTILES:
+                summary["p%d" % round(q * 100)] = self.__quantile(
+                    buckets, count, maximum, q)
+            stats["histograms"].setdefault(name, {})[key] = summary
+        return stats
+
+    def tojson(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def totext(self):
+        """
+        totext() -> string
 
-    def close(self):
+        Returns the current values one per line, as "name{key} value", or
+        "name{key,stat} value" for histograms, for scraping or reading.
         """
-        close()
 
-        Closes the peer connection. The send and recv methods will not work
-        after this call.
+        stats = self.snapshot()
+        lines = ["uptime %.3f" % stats["uptime"]]
+        for kind in ("counters", "gauges"):
+            for name, values in sorted(stats[kind].items()):
+                for key, value in sorted(values.items()):
+                    lines.append("%s{%s} %s" % (name, key, value))
+        for name, values in sorted(stats["histograms"].items()):
+            for key, summary in sorted(values.items()):
+                for stat, value in summary.items():
+                    lines.append("%s{%s,%s} %.6g" % (name, key, stat, value))
+        return "\n".join(lines) + "\n"
+
+
+# **********************************************************
+
+
+class BTPeerWorkerPool:
+    """
+    A fixed number of threads running message handlers, fed from a
+    separate bounded queue per message type. Idle workers take jobs from
+    the queues in turn, so a burst of one expensive message type cannot
+    starve the others, and a full queue makes submit fail fast instead of
+    piling up work the peer cannot keep up with. A message type whose jobs
+    hold a worker for long, like a file transfer, can also be limited to a
+    few workers at a time, so that it cannot occupy them all.
+    """
+
+    def __init__(self, maxworkers=8, maxqueue=32, debug=False):
+        self.maxworkers = maxworkers
+        self.maxqueue = maxqueue    # default queue depth for each msgtype
+        self.maxqueues = {}         # msgtype ==> queue depth, overrides maxqueue
+        self.maxrunning = {}        # msgtype ==> most jobs running at once, if limited
+        self.debug = debug
+
+        self.cond = threading.Condition()
+        self.queues = {}    # msgtype ==> deque of (future, fn, args)
+        self.ready = collections.deque()    # msgtypes with queued jobs, in turn
+        self.handletime = {}    # msgtype ==> moving average of seconds per job
+        self.running = {}       # msgtype ==> number of jobs running
+        self.threads = []
+        self.stopped = False
+
+    def __debug(self, msg):
+        if self.debug:
+            btdebug(msg)
+
+    def submit(self, msgtype, fn, *args):
         """
+        submit(message type, function, arguments...) -> Future or None
 
-        self.s.close()
-        self.s = None
+        Queues fn(*args) to run on a worker thread. Returns None, without
+        queuing it, if the queue for msgtype is full.
+        """
+
+        with self.cond:
+            jobs = self.queues.setdefault(msgtype, collections.deque())
+            if self.stopped or len(jobs) >= self.maxqueues.get(msgtype, self.maxqueue):
+                return None
+
+            future = Future()
+            jobs.append((future, fn, args))
+            self.__schedule(msgtype)
+            if len(self.threads) < self.maxworkers:
+                t = threading.Thread(target=self.__work, daemon=True,
+                                     name="btworker-%d" % len(self.threads))
+                self.threads.append(t)
+                t.start()
+            self.cond.notify()
+            return future
+
+    def __schedule(self, msgtype):
+        """Makes msgtype's queue take its turn, if it has jobs and may run one more."""
+
+        if (self.queues[msgtype] and msgtype not in self.ready and
+                self.running.get(msgtype, 0) < self.maxrunning.get(msgtype, self.maxworkers)):
+            self.ready.append(msgtype)
+
+    def retryafter(self, msgtype):
+        """
+        Returns an estimate, in seconds, of how long it will take the
+        workers to get through the jobs now queued for msgtype.
+        """
+
+        with self.cond:
+            queued = len(self.queues.get(msgtype, ()))
+            handletime = self.handletime.get(msgtype, 0.0)
+        workers = min(self.maxworkers, self.maxrunning.get(msgtype, self.maxworkers))
+        return max(0.1, (queued + 1) * handletime / workers)
+
+    def __work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                msgtype = self.ready.popleft()
+                future, fn, args = self.queues[msgtype].popleft()
+                self.running[msgtype] = self.running.get(msgtype, 0) + 1
+                self.__schedule(msgtype)
+
+            elapsed = None
+            if future.set_running_or_notify_cancel():
+                start = time.monotonic()
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+                elapsed = time.monotonic() - start
+
+            with self.cond:
+                if elapsed is not None:
+                    handletime = self.handletime.get(msgtype)
+                    self.handletime[msgtype] = elapsed if handletime is None \
+                        else 0.8 * handletime + 0.2 * elapsed
+                self.running[msgtype] -= 1
+                if msgtype not in self.ready:
+                    self.__schedule(msgtype)
+                    self.cond.notify()
+
+    def shutdown(self):
+        """
+        shutdown()
+
+        Stops the workers once they finish their current jobs and cancels
+        the jobs still queued.
+        """
+
+        with self.cond:
+            self.stopped = True
+            for jobs in self.queues.values():
+                for future, _, _ in jobs:
+                    future.cancel()
+                jobs.clear()
+            self.ready.clear()
+            self.cond.notify_all()
+        self.__debug("Worker pool stopped")
+
+
+# **********************************************************
+
+
+class BTPeerConnection:
+
+    def __init__(self, peerid, host, port, sock=None, debug=False, timeout=None):
+        # any exceptions thrown upwards
+
+        self.peerid = peerid
+        self.host = host
+        self.port = int(port)
+        self.debug = debug
+
+        # timeout bounds connecting and, until settimeout is called, every
+        # later send and receive
+        self.timeout = timeout
+        self.deadline = None
+
+        if not sock:
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.settimeout(timeout)
+            self.s.connect((self.host, self.port))
+        else:
+            self.s = sock
+
+        # replies are written as several small messages; don't let Nagle's
+        # algorithm hold them back on keep-alive connections
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # set on the per-request views of a multiplexed connection
+        self.reqid = None
+        self.bytesout = 0   # bytes sent through this connection (or view)
+        self.writelock = None
+
+        # reused for every message header read from this connection
+        self.header = bytearray(12)
+        # whether the last message received came through sendstream
+        self.streamed = False
+        # whether the last receive gave up because the socket timed out
+        self.timedout = False
+
+    def __debug(self, msg):
+        if self.debug:
+            btdebug(msg)
+
+    def settimeout(self, timeout, deadline=None):
+        """
+        settimeout(seconds, deadline) -> ()
+
+        Bounds every following send and receive on this connection to
+        timeout seconds each, and all of them together to finish before
+        deadline, a time.monotonic() value. Either may be None for no limit.
+        """
+
+        self.timeout = timeout
+        self.deadline = deadline
+        self.s.settimeout(timeout)
+
+    def __applydeadline(self):
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("deadline exceeded")
+        self.s.settimeout(remaining if self.timeout is None
+                          else min(self.timeout, remaining))
+
+    def __sendbuffers(self, buffers):
+        """
+        Writes the buffers out in order with scatter-gather sendmsg calls,
+        so a header and a large body go out without being joined first.
+        """
+
+        if not hasattr(self.s, "sendmsg"):     # e.g. Windows
+            for buf in buffers:
+                self.__applydeadline()
+                self.s.sendall(buf)
+            return
+
+        views = [memoryview(buf).cast("B") for buf in buffers if len(buf)]
+        while views:
+            self.__applydeadline()
+            sent = self.s.sendmsg(views)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+
+    def __recvinto(self, view):
+        """
+        Fills view completely from the socket. Returns False if the
+        connection was closed before anything was read and raises EOFError
+        if it was closed part of the way through.
+        """
+
+        nread = 0
+        while nread < len(view):
+            self.__applydeadline()
+            n = self.s.recv_into(view[nread:])
+            if not n:
+                if not nread:
+                    return False
+                raise EOFError("connection closed mid-message")
+            nread += n
+        return True
+
+    def __recvbody(self, msglen):
+        body = bytearray(msglen)
+        if msglen and not self.__recvinto(memoryview(body)):
+            raise EOFError("connection closed mid-message")
+        return memoryview(body)
+
+    def forrequest(self, reqid):
+        """
+        forrequest(request id) -> BTPeerConnection
+
+        Returns a view of this multiplexed connection whose senddata tags
+        every message with reqid, so a handler can reply to one request
+        without knowing about the others in flight.
+        """
+
+        stream = copy.copy(self)
+        stream.reqid = reqid
+        return stream
+
+    def senddata(self, msgtype, msgdata):
+        """
+        senddata(message type, message data) -> boolean status
+
+        Sends a message through a peer connection. The message data may be
+        a string, which is sent UTF-8 encoded, or any bytes-like object.
+        Returns True on success or False if there was an error.
+        """
+
+        if isinstance(msgdata, str):
+            msgdata = msgdata.encode()
+        if self.reqid is not None:
+            return self.sendframe(msgtype, self.reqid, msgdata)
+        return self.sendbytes(msgtype, msgdata)
+
+    def sendbytes(self, msgtype, msgdata):
+        """
+        sendbytes(message type, bytes-like message data) -> boolean status
+
+        Sends a message whose data is any bytes-like object (bytes,
+        bytearray, memoryview, a contiguous NumPy array, ...) without
+        copying it. Returns True on success or False if there was an error.
+        """
+
+        try:
+            msglen = memoryview(msgdata).nbytes
+            header = struct.pack("!4sL", msgtype.encode(), msglen)
+            self.__sendbuffers([header, msgdata])
+            self.bytesout += len(header) + msglen
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return True
+
+    def sendframe(self, msgtype, reqid, msgdata):
+        """
+        sendframe(message type, request id, message data) -> boolean status
+
+        Sends a message tagged with a request id over a multiplexed
+        connection. Returns True on success or False if there was an error.
+        """
+
+        try:
+            if isinstance(msgdata, str):
+                msgdata = msgdata.encode()
+            msglen = memoryview(msgdata).nbytes
+            header = struct.pack("!4sLL", msgtype.encode(), reqid, msglen)
+            with self.writelock:
+                self.__sendbuffers([header, msgdata])
+            self.bytesout += len(header) + msglen
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return True
+
+    def sendstream(self, msgtype, chunks):
+        """
+        sendstream(message type, iterable of message data chunks) -> boolean status
+
+        Sends a message as a STREAM header followed by one CHUNK message per
+        chunk (each a string or bytes-like object) and an empty CHUNK, so
+        that neither side has to hold the whole message in memory. chunks
+        may be a generator; if it raises, the stream is left unterminated
+        and the receiver sees it break off. Returns True on success or
+        False if there was an error.
+        """
+
+        if not self.senddata(STREAM, msgtype):
+            return False
+
+        try:
+            for chunk in chunks:
+                if len(chunk) and not self.senddata(CHUNK, chunk):
+                    return False
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return self.senddata(CHUNK, b"")
+
+    def sendfile(self, msgtype, file, offset=0, count=None, chunksize=1 << 20):
+        """
+        sendfile(message type, file opened in binary mode, offset, count,
+                 chunk size) -> boolean status
+
+        Sends count bytes of a file (the rest of it by default) from offset
+        on as a stream (see sendstream) of chunks of at most chunksize
+        bytes, each written with socket.sendfile so that the data goes
+        from the file to the socket without being copied through Python
+        where the platform allows it. Returns True on success or False if
+        there was an error.
+        """
+
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if not self.senddata(STREAM, msgtype):
+            return False
+
+        try:
+            end = offset + count
+            while offset < end:
+                n = min(chunksize, end - offset)
+                if self.reqid is not None:
+                    header = struct.pack("!4sLL", CHUNK.encode(), self.reqid, n)
+                    with self.writelock:
+                        self.__sendfilebody(header, file, offset, n)
+                else:
+                    header = struct.pack("!4sL", CHUNK.encode(), n)
+                    self.__sendfilebody(header, file, offset, n)
+                self.bytesout += len(header) + n
+                offset += n
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return self.senddata(CHUNK, b"")
+
+    def __sendfilebody(self, header, file, offset, count):
+        self.__sendbuffers([header])
+        self.__applydeadline()
+        if self.s.sendfile(file, offset, count) != count:
+            raise EOFError("file ended before %d bytes" % count)
+
+    def recvframebytes(self):
+        """
+        recvframebytes() -> (msgtype, request id, memoryview of message data)
+
+        Receives a message tagged with a request id from a multiplexed
+        connection without decoding its data. Returns (None, None, None) if
+        there was any error.
+        """
+
+        try:
+            header = memoryview(self.header)
+            if not self.__recvinto(header):
+                return (None, None, None)
+            msgtype, reqid, msglen = struct.unpack("!4sLL", header)
+            msg = self.__recvbody(msglen)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None, None)
+
+        return (msgtype.decode(), reqid, msg)
+
+    def recvframe(self):
+        """
+        recvframe() -> (msgtype, request id, msgdata)
+
+        Receives a message tagged with a request id from a multiplexed
+        connection and decodes its data as UTF-8. Returns (None, None, None)
+        if there was any error.
+        """
+
+        msgtype, reqid, msg = self.recvframebytes()
+        if msgtype is None:
+            return (None, None, None)
+
+        try:
+            return (msgtype, reqid, str(msg, "utf-8"))
+        except UnicodeDecodeError:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None, None)
+
+    def __recvmsg(self):
+        if self.reqid is not None:
+            return (None, None)     # requests carry a single message
+
+        self.timedout = False
+        try:
+            header = memoryview(self.header)[:8]
+            if not self.__recvinto(header):
+                return (None, None)
+            msgtype, msglen = struct.unpack("!4sL", header)
+            msg = self.__recvbody(msglen)
+        except socket.timeout:
+            self.__debug("Timed out receiving from %s:%d" %
+                         (self.host, self.port))
+            self.timedout = True
+            return (None, None)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None)
+
+        return (msgtype.decode(), msg)
+
+    def __recvchunks(self):
+        while True:
+            msgtype, msg = self.__recvmsg()
+            if msgtype != CHUNK:
+                raise EOFError("stream broke off")
+            if not len(msg):
+                return
+            yield msg
+
+    def recvstream(self):
+        """
+        recvstream() -> (msgtype, iterator of message data chunks)
+
+        Receives a message that may have been sent with sendstream; if so,
+        self.streamed is set and its chunks are read lazily as the iterator
+        is consumed, raising EOFError if the stream breaks off. The iterator
+        must be exhausted before anything else is received on this
+        connection. A plain message comes back as a single chunk. Returns
+        (None, None) if there was any error.
+        """
+
+        self.streamed = False
+        msgtype, msg = self.__recvmsg()
+        if msgtype != STREAM:
+            return (msgtype, [msg] if msgtype else None)
+
+        self.streamed = True
+        return (str(msg, "utf-8"), self.__recvchunks())
+
+    def recvbytes(self):
+        """
+        recvbytes() -> (msgtype, memoryview of message data)
+
+        Receives a message from a peer connection, reading exactly the
+        length given in its header straight into a buffer allocated for
+        it, and returns that buffer without decoding it. A streamed message
+        is joined into one buffer. Returns (None, None) if there was any
+        error.
+        """
+
+        msgtype, chunks = self.recvstream()
+        if not self.streamed:
+            return (msgtype, chunks[0] if msgtype else None)
+
+        try:
+            return (msgtype, memoryview(b"".join(chunks)))
+        except EOFError:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None)
+
+    def recvdata(self):
+        """
+        recvdata() -> (msgtype, msgdata)
+
+        Receives a message from a peer connection and decodes its data as
+        UTF-8. Returns (None, None) if there was any error.
+        """
+
+        msgtype, msg = self.recvbytes()
+        if msgtype is None:
+            return (None, None)
+
+        try:
+            return (msgtype, str(msg, "utf-8"))
+        except UnicodeDecodeError:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None)
+
+    def close(self):
+        """
+        close()
+
+        Closes the peer connection. The send and recv methods will not work
+        after this call.
+        """
+
+        self.s.close()
+        self.s = None
+
+    def __str__(self):
+        return "|%s|" % self.peerid
+
+
+# **********************************************************
+
+
+class BTPeerConnectionPool:
+    """
+    Keeps keep-alive BTPeerConnections to other peers open for reuse, so
+    that consecutive messages to the same peer do not each pay for a TCP
+    handshake and teardown. At most maxperpeer connections are open to any
+    one host:port; idle connections are closed after idletimeout seconds
+    and health-checked before they are handed out again. Peers that do not
+    understand KEEPALIVE are remembered and served by one-shot connections.
+    The pool also holds at most one shared BTPeerMuxConnection per peer.
+    """
+
+    def __init__(self, maxperpeer=4, idletimeout=30.0, acquiretimeout=5.0, debug=False):
+        self.maxperpeer = maxperpeer
+        self.idletimeout = idletimeout
+        self.acquiretimeout = acquiretimeout
+        self.debug = debug
+
+        self.cond = threading.Condition()
+        self.idle = {}      # (host, port) ==> [(connection, last used)]
+        self.nopen = {}     # (host, port) ==> number of open connections
+        self.legacy = set()  # (host, port) of peers without keep-alive
+        self.muxes = {}     # (host, port) ==> BTPeerMuxConnection
+        self.nomux = set()  # (host, port) of peers without multiplexing
+        self.lastpurge = time.time()
+
+    def __debug(self, msg):
+        if self.debug:
+            btdebug(msg)
+
+    def __isalive(self, peerconn):
+        """
+        An idle keep-alive connection must have nothing to read: readability
+        means the other end has closed it (or broken the protocol).
+        """
+
+        try:
+            readable, _, _ = select.select([peerconn.s], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def __purge(self, now):
+        """Closes idle connections unused for longer than idletimeout."""
+
+        for key, conns in self.idle.items():
+            while conns and now - conns[0][1] > self.idletimeout:
+                peerconn, _ = conns.pop(0)
+                peerconn.close()
+                self.nopen[key] -= 1
+
+        for key, mux in list(self.muxes.items()):
+            if not mux.alive or mux.idlesince(now) > self.idletimeout:
+                del self.muxes[key]
+                mux.close()
+
+        self.lastpurge = now
+
+    def __connect(self, peerid, host, port, timeout):
+        peerconn = BTPeerConnection(
+            peerid, host, port, None, self.debug, timeout)
+        peerconn.reused = False
+        if peerconn.senddata(KEEPALIVE, "") and peerconn.recvdata()[0] == DONE:
+            return peerconn
+
+        peerconn.close()
+        if peerconn.timedout:   # a slow peer, not necessarily a legacy one
+            raise socket.timeout("keep-alive handshake timed out")
+
+        self.__debug("No keep-alive support at %s:%d" % (host, int(port)))
+        with self.cond:
+            self.legacy.add((host, int(port)))
+            self.cond.notify_all()
+        return None
+
+    def acquire(self, peerid, host, port, timeout=None, deadline=None, block=True):
+        """
+        acquire(peer id, host, port, connect timeout, deadline, block) -> BTPeerConnection or None
+
+        Returns a keep-alive connection to host:port, reusing an idle one if
+        possible; a new connection waits at most timeout seconds to connect.
+        If all maxperpeer connections are in use, waits for one to be
+        released for at most acquiretimeout seconds, or not at all unless
+        block is set. If deadline (a time.monotonic() time) is given, the
+        whole acquisition, waiting and connecting, ends by then. Returns
+        None if the peer does not support keep-alive or no connection
+        became available in time, in which case the caller should fall
+        back to a one-shot connection.
+        """
+
+        key = (host, int(port))
+        waituntil = time.monotonic() + self.acquiretimeout
+        if deadline is not None:
+            waituntil = min(waituntil, deadline)
+        with self.cond:
+            while True:
+                if key in self.legacy:
+                    return None
+
+                now = time.time()
+                if now - self.lastpurge > self.idletimeout / 2:
+                    self.__purge(now)
+
+                conns = self.idle.get(key)
+                if conns:
+                    peerconn, _ = conns.pop()
+                    if self.__isalive(peerconn):
+                        peerconn.peerid = peerid
+                        peerconn.reused = True
+                        return peerconn
+                    peerconn.close()
+                    self.nopen[key] -= 1
+                    continue
+
+                if self.nopen.get(key, 0) < self.maxperpeer:
+                    self.nopen[key] = self.nopen.get(key, 0) + 1
+                    break
+
+                remaining = waituntil - time.monotonic()
+                if not block or remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.__discarded(key)
+                return None
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        try:
+            peerconn = self.__connect(peerid, host, port, timeout)
+        except:
+            peerconn = None
+            self.__discarded(key)
+            raise
+
+        if not peerconn:
+            self.__discarded(key)
+        return peerconn
+
+    def getmux(self, peerid, host, port, timeout=None):
+        """
+        getmux(peer id, host, port, timeout) -> BTPeerMuxConnection or None
+
+        Returns the shared multiplexed connection to host:port, opening it
+        if needed. Returns None if the peer does not support multiplexing.
+        """
+
+        key = (host, int(port))
+        with self.cond:
+            if key in self.nomux:
+                return None
+            mux = self.muxes.get(key)
+            if mux and mux.alive:
+                return mux
+
+        mux = BTPeerMuxConnection(peerid, host, port, self.debug, timeout)
+        with self.cond:
+            if not mux.alive:
+                self.__debug("No multiplexing support at %s:%d" %
+                             (host, int(port)))
+                self.nomux.add(key)
+                return None
+
+            other = self.muxes.get(key)
+            if other and other.alive:   # lost a race to open it
+                mux.close()
+                return other
+            self.muxes[key] = mux
+            return mux
+
+    def __discarded(self, key):
+        with self.cond:
+            self.nopen[key] -= 1
+            self.cond.notify()
+
+    def release(self, peerconn):
+        """Returns a healthy connection to the pool for reuse."""
+
+        with self.cond:
+            key = (peerconn.host, peerconn.port)
+            self.idle.setdefault(key, []).append((peerconn, time.time()))
+            self.cond.notify()
+
+    def discard(self, peerconn):
+        """Closes a connection that is broken or in an unknown state."""
+
+        peerconn.close()
+        self.__discarded((peerconn.host, peerconn.port))
+
+    def closepeer(self, host, port):
+        """Closes all idle connections to host:port."""
+
+        key = (host, int(port))
+        with self.cond:
+            for peerconn, _ in self.idle.pop(key, []):
+                peerconn.close()
+                self.nopen[key] -= 1
+            self.legacy.discard(key)
+
+            mux = self.muxes.pop(key, None)
+            if mux:
+                mux.close()
+            self.nomux.discard(key)
+
+    def closeall(self):
+        """Closes every idle connection in the pool."""
+
+        with self.cond:
+            for key in set(self.idle) | set(self.muxes):
+                self.closepeer(*key)
+
+
+# **********************************************************
+
+
+class BTPeerMuxConnection:
+    """
+    Client side of a multiplexed connection: many threads can have requests
+    in flight on the one socket at the same time. Every request is tagged
+    with a fresh request id, and a reader thread hands each reply to the
+    request it answers, so replies may arrive in any order.
+    """
+
+    def __init__(self, peerid, host, port, debug=False, timeout=None):
+        self.peerid = peerid
+        self.host = host
+        self.port = int(port)
+        self.debug = debug
+
+        self.lock = threading.Lock()
+        self.pending = {}   # request id ==> queue of replies
+        self.reqids = itertools.count(1)
+        self.lastused = time.time()
+        self.alive = False
+
+        # any connection exceptions thrown upwards
+        self.conn = BTPeerConnection(peerid, host, port, None, debug, timeout)
+        self.s = self.conn.s    # kept for close, whatever the reader does
+        if not self.conn.senddata(MULTIPLEX, "") or self.conn.recvdata()[0] != DONE:
+            self.conn.close()
+            if self.conn.timedout:
+                raise socket.timeout("multiplexing handshake timed out")
+            return
+
+        self.conn.settimeout(None)  # the reader thread waits indefinitely
+        self.conn.writelock = threading.Lock()
+        self.alive = True
+        t = threading.Thread(target=self.__readloop, daemon=True)
+        t.start()
+
+    def __readloop(self):
+        while True:
+            msgtype, reqid, msgdata = self.conn.recvframebytes()
+            if not msgtype:
+                break
+            with self.lock:
+                replies = self.pending.get(reqid)
+            if replies:     # replies to requests sent with waitreply=False are dropped
+                replies.put((msgtype, msgdata))
+
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for replies in pending.values():
+            replies.put((None, None))
+        self.s.close()  # leaves self.conn.s, so late close and send calls fail quietly
+
+    def idlesince(self, now):
+        """Returns for how long no request has been in flight."""
+
+        with self.lock:
+            return 0 if self.pending else now - self.lastused
+
+    def request(self, msgtype, msgdata, waitreply=True, timeout=None, raw=False):
+        """
+        request(message type, message data, wait for a reply, timeout, raw) -> [(reply type, reply data), ...]
+
+        Sends a request and, if waitreply is set, blocks until all of its
+        replies have arrived or, if timeout is given, until that many
+        seconds have passed. Reply data is decoded as UTF-8 unless raw is
+        set. Returns None if the connection failed before any reply was
+        received, so the caller can retry elsewhere.
+        """
+
+        replies = queue.Queue()
+        with self.lock:
+            if not self.alive:
+                return None
+            reqid = next(self.reqids) & 0xFFFFFFFF
+            if waitreply:
+                self.pending[reqid] = replies
+
+        if not self.conn.sendframe(msgtype, reqid, msgdata):
+            self.close()
+            return None
+
+        msgreply = []
+        if waitreply:
+            deadline = None if timeout is None else time.time() + timeout
+
+            def nextreply():
+                if deadline is None:
+                    return replies.get()
+                try:
+                    return replies.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    return (DONE, "")   # give up with whatever has arrived
+
+            onereply = nextreply()
+            while onereply[0] not in (None, DONE):
+                if onereply[0] == STREAM:   # join a streamed reply
+                    msgtype, chunks = str(onereply[1], "utf-8"), []
+                    onereply = nextreply()
+                    while onereply[0] == CHUNK and onereply[1]:
+                        chunks.append(onereply[1])
+                        onereply = nextreply()
+                    if onereply[0] != CHUNK:
+                        break
+                    onereply = (msgtype, b"".join(chunks))
+                if not raw:
+                    try:
+                        onereply = (onereply[0], str(onereply[1], "utf-8"))
+                    except UnicodeDecodeError:
+                        if self.debug:
+                            traceback.print_exc()
+                        break
+                msgreply.append(onereply)
+                onereply = nextreply()
+
+            with self.lock:
+                self.pending.pop(reqid, None)
+            if onereply[0] is None and not msgreply:
+                return None
+
+        with self.lock:
+            self.lastused = time.time()
+        return msgreply
+
+    def close(self):
+        """
+        close()
+
+        Closes the connection; requests still waiting for replies get back
+        what they received so far.
+        """
+
+        with self.lock:
+            self.alive = False
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)    # wakes the reader thread
+        except OSError:
+            pass
+
+    def __str__(self):
+        return "|%s|" % self.peerid
+
+
+# **********************************************************
+
+
+class BTPeerAsyncConnection:
+    """
+    Server-side peer connection used by BTPeer.mainloop_async. It wraps an
+    asyncio stream pair but exposes the same blocking senddata/recvdata
+    interface as BTPeerConnection, so handlers work unchanged whether they
+    are called on the event loop or from an executor thread.
+    """
+
+    def __init__(self, peerid, host, port, reader, writer, debug=False, timeout=None):
+        self.peerid = peerid
+        self.host = host
+        self.port = int(port)
+        self.debug = debug
+        self.timeout = timeout  # bounds sends and receives from other threads
+
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loopthread = threading.get_ident()
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.reqid = None
+        self.bytesout = 0   # bytes sent through this connection (or view)
+        self.streamed = False
+
+    def __makeheader(self, msgtype, msglen):
+        if self.reqid is not None:
+            return struct.pack("!4sLL", msgtype.encode(), self.reqid, msglen)
+        return struct.pack("!4sL", msgtype.encode(), msglen)
+
+    def forrequest(self, reqid):
+        """
+        forrequest(request id) -> BTPeerAsyncConnection
+
+        Returns a view of this multiplexed connection whose senddata tags
+        every message with reqid.
+        """
+
+        stream = copy.copy(self)
+        stream.reqid = reqid
+        return stream
+
+    def __debug(self, msg):
+        if self.debug:
+            btdebug(msg)
+
+    async def __write(self, header, msgdata):
+        self.writer.write(header)
+        self.writer.write(msgdata)
+        await self.writer.drain()
+
+    def senddata(self, msgtype, msgdata):
+        """
+        senddata(message type, message data) -> boolean status
+
+        Sends a message through the peer connection. The message data may be
+        a string, which is sent UTF-8 encoded, or any bytes-like object. On
+        the event loop thread the message is buffered without blocking; from
+        any other thread the call waits until the message has been flushed
+        to the transport.
+        """
+
+        try:
+            if isinstance(msgdata, str):
+                msgdata = msgdata.encode()
+            msglen = memoryview(msgdata).nbytes
+            header = self.__makeheader(msgtype, msglen)
+            if threading.get_ident() == self.loopthread:
+                self.writer.write(header)
+                self.writer.write(msgdata)
+            else:
+                self.__wait(self.__write(header, msgdata))
+            self.bytesout += len(header) + msglen
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return True
+
+    def sendstream(self, msgtype, chunks):
+        """
+        sendstream(message type, iterable of message data chunks) -> boolean status
+
+        Streams a message like BTPeerConnection.sendstream.
+        """
+
+        if not self.senddata(STREAM, msgtype):
+            return False
+
+        try:
+            for chunk in chunks:
+                if len(chunk) and not self.senddata(CHUNK, chunk):
+                    return False
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return self.senddata(CHUNK, b"")
+
+    def sendfile(self, msgtype, file, offset=0, count=None, chunksize=1 << 20):
+        """
+        sendfile(message type, file opened in binary mode, offset, count,
+                 chunk size) -> boolean status
+
+        Streams part of a file like BTPeerConnection.sendfile, through the
+        event loop's sendfile. It may only be called from an executor
+        thread. On a multiplexed connection, where other requests' replies
+        must be able to go out between the chunks, the chunks are read
+        and sent as ordinary messages instead.
+        """
+
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if not self.senddata(STREAM, msgtype):
+            return False
+
+        try:
+            end = offset + count
+            while offset < end:
+                n = min(chunksize, end - offset)
+                if self.reqid is not None:
+                    file.seek(offset)
+                    if not self.senddata(CHUNK, file.read(n)):
+                        return False
+                else:
+                    header = self.__makeheader(CHUNK, n)
+                    self.__wait(self.__sendfile(header, file, offset, n))
+                    self.bytesout += len(header) + n
+                offset += n
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return False
+        return self.senddata(CHUNK, b"")
+
+    async def __sendfile(self, header, file, offset, count):
+        self.writer.write(header)
+        # waits for the header to be flushed before sending the file
+        if await self.loop.sendfile(self.writer.transport, file, offset, count) != count:
+            raise EOFError("file ended before %d bytes" % count)
+
+    async def __recvmsgasync(self):
+        try:
+            msgtype, msglen = struct.unpack(
+                "!4sL", await self.reader.readexactly(8))
+            msg = await self.reader.readexactly(msglen)
+        except asyncio.IncompleteReadError:
+            return (None, None)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None)
+
+        return (msgtype.decode(), msg)
+
+    def __wait(self, coro):
+        """Runs coro on the event loop and waits at most self.timeout for it."""
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def __recvchunks(self):
+        while True:
+            msgtype, msg = self.__wait(self.__recvmsgasync())
+            if msgtype != CHUNK:
+                raise EOFError("stream broke off")
+            if not msg:
+                return
+            yield msg
+
+    async def recvstreamasync(self, lazytypes=()):
+        """
+        recvstreamasync(message types to stream lazily) -> (msgtype, iterator of message data chunks)
+
+        Coroutine counterpart of BTPeerConnection.recvstream. A streamed
+        message whose type is in lazytypes comes back as a blocking iterator
+        that may only be consumed from an executor thread; any other stream
+        is read in full here and returned as a single chunk.
+        """
+
+        self.streamed = False
+        msgtype, msg = await self.__recvmsgasync()
+        if msgtype != STREAM:
+            return (msgtype, [msg] if msgtype else None)
+
+        self.streamed = True
+        msgtype = msg.decode()
+        if msgtype.upper() in lazytypes:
+            return (msgtype, self.__recvchunks())
+
+        chunks = []
+        while True:
+            chunktype, chunk = await self.__recvmsgasync()
+            if chunktype != CHUNK:
+                return (None, None)
+            if not chunk:
+                return (msgtype, [b"".join(chunks)])
+            chunks.append(chunk)
+
+    async def recvbytesasync(self):
+        """
+        recvbytesasync() -> (msgtype, bytes of message data)
+
+        Coroutine that receives a message from the stream without decoding
+        its data; a streamed message is joined. Returns (None, None) if
+        there was any error.
+        """
+
+        msgtype, chunks = await self.recvstreamasync()
+        return (msgtype, chunks[0] if msgtype else None)
+
+    async def recvdataasync(self):
+        """
+        recvdataasync() -> (msgtype, msgdata)
+
+        Coroutine that receives a message from the stream and decodes its
+        data as UTF-8. Returns (None, None) if there was any error.
+        """
+
+        msgtype, msg = await self.recvbytesasync()
+        if msgtype is None:
+            return (None, None)
+
+        try:
+            return (msgtype, msg.decode())
+        except UnicodeDecodeError:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None)
+
+    async def recvframebytesasync(self):
+        """
+        recvframebytesasync() -> (msgtype, request id, bytes of message data)
+
+        Coroutine that receives a message tagged with a request id from a
+        multiplexed stream without decoding its data. Returns
+        (None, None, None) if there was any error.
+        """
+
+        try:
+            msgtype, reqid, msglen = struct.unpack(
+                "!4sLL", await self.reader.readexactly(12))
+            msg = await self.reader.readexactly(msglen)
+        except asyncio.IncompleteReadError:
+            return (None, None, None)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            return (None, None, None)
+
+        return (msgtype.decode(), reqid, msg)
+
+    def recvdata(self):
+        """
+        recvdata() -> (msgtype, msgdata)
+
+        Blocking counterpart of recvdataasync for handlers running in an
+        executor thread. It cannot be called from the event loop thread.
+        """
+
+        assert threading.get_ident() != self.loopthread
+        if self.reqid is not None:
+            return (None, None)     # requests carry a single message
+        try:
+            return self.__wait(self.recvdataasync())
+        except FutureTimeoutError:
+            return (None, None)
+
+    def recvbytes(self):
+        """
+        recvbytes() -> (msgtype, bytes of message data)
+
+        Blocking counterpart of recvbytesasync for handlers running in an
+        executor thread. It cannot be called from the event loop thread.
+        """
+
+        assert threading.get_ident() != self.loopthread
+        if self.reqid is not None:
+            return (None, None)
+        try:
+            return self.__wait(self.recvbytesasync())
+        except FutureTimeoutError:
+            return (None, None)
+
+    def close(self):
+        """
+        close()
+
+        Closes the underlying stream. The send and recv methods will not work
+        after this call.
+        """
+
+        self.writer.close()
 
     def __str__(self):
         return "|%s|" % self.peerid